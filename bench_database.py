@@ -0,0 +1,82 @@
+"""Compare ops/sec of per-call sqlite3 connections with the pooled database layer,
+and time the bulk write API on BULK_USERS rows.
+
+Usage: python bench_database.py [operations]
+"""
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+
+import database
+
+USERS = 1000
+BULK_USERS = 100000
+
+# Reference implementation of the old per-call connection helpers
+def legacy_get_user(user_id):
+    conn = sqlite3.connect(database.DB_PATH)
+    c = conn.cursor()
+    c.execute('SELECT * FROM users WHERE id = ?', (user_id,))
+    user = c.fetchone()
+    conn.close()
+    return user
+
+def legacy_update_user_status(user_id, status):
+    conn = sqlite3.connect(database.DB_PATH)
+    c = conn.cursor()
+    c.execute('UPDATE users SET status = ? WHERE id = ?', (status, user_id))
+    conn.commit()
+    conn.close()
+
+def legacy_is_user_registered(user_id):
+    conn = sqlite3.connect(database.DB_PATH)
+    c = conn.cursor()
+    c.execute('SELECT registered FROM users WHERE id = ?', (user_id,))
+    result = c.fetchone()
+    conn.close()
+    return result[0] if result else False
+
+def run(label, get_user, update_user_status, is_user_registered, operations):
+    start = time.perf_counter()
+    for i in range(operations // 3):
+        user_id = i % USERS
+        get_user(user_id)
+        update_user_status(user_id, "VIP" if i % 2 else "Free")
+        is_user_registered(user_id)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {operations / elapsed:>12.0f} ops/sec")
+
+def timed(label, func):
+    start = time.perf_counter()
+    rows = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<12} {rows} rows in {elapsed:.2f}s")
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, 'bench.db')
+        database.init_db()
+        with database.transaction():
+            for user_id in range(USERS):
+                database.create_user(user_id, f"user{user_id}")
+        database.close_connections()
+
+        # The legacy helpers ran against the default rollback journal
+        conn = sqlite3.connect(database.DB_PATH)
+        conn.execute('PRAGMA journal_mode=DELETE')
+        conn.close()
+        run("legacy", legacy_get_user, legacy_update_user_status, legacy_is_user_registered, operations)
+
+        run("pooled", database.get_user, database.update_user_status, database.is_user_registered, operations)
+
+        user_ids = range(USERS, USERS + BULK_USERS)
+        timed("bulk upsert", lambda: database.bulk_upsert_users({'id': user_id, 'username': f"user{user_id}"} for user_id in user_ids))
+        timed("bulk status", lambda: database.bulk_set_status(user_ids, "VIP"))
+        timed("bulk approve", lambda: database.bulk_approve(user_ids))
+        database.close_connections()
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,79 @@
 import os
+import re
 import sys
 import logging
 import aiohttp
 import time
+import random
 import asyncio
-import json
 import os.path
 import ctypes
 import ctypes.wintypes
 import io  # Required for exporting users
-from datetime import datetime
+from datetime import datetime, date, timedelta
+from functools import partial
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
-from telegram.error import Conflict, RetryAfter
+from telegram.error import TelegramError, Conflict, RetryAfter, BadRequest, NetworkError, TimedOut
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
+    CallbackContext,
     filters,
     ContextTypes
 )
-from database import init_db, get_user, create_user, update_user_status, get_all_users, mark_deposited, get_user_count, reset_user
+import database
+from database import (
+    init_db, update_user_status, get_all_users,
+    get_user_record, upsert_user, update_user_fields, get_user_counters, get_all_user_records,
+    update_deposit_message_id, snapshot_user_records, get_changed_user_records,
+    get_sync_watermark, set_sync_watermark, bulk_approve, run_db, shutdown_db, NEW_USER_DEFAULTS, get_user_id_page,
+    create_broadcast_job, create_segmented_broadcast_job, apply_funnel_events, get_broadcast_job, list_broadcast_jobs, set_broadcast_job_state, get_tombstone_counts
+)
+import user_store
+import http_client
+from outbox import OutboxRateLimiter
+from postback import start_postback_server, stop_postback_server
+from broadcast import (
+    TEMPLATE_FIELDS, compile_template, choose_parse_mode, wake_runner, stop_job, start_runner, stop_runner
+)
 
 # Load environment variables
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8069045379:AAH90DA3JkZ2noQeSXLg2asssGySuZrzS7I")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "7135894706"))
+# Seconds between incremental syncs of the users table into users.json
+USERS_JSON_SYNC_INTERVAL = int(os.getenv("USERS_JSON_SYNC_INTERVAL", "60"))
+# sync_state name of the users.json mirror
+USERS_JSON_SYNC = "users_json"
+# Full-jitter backoff of safe_telegram_request: a retry waits up to min(MAX, BASE * 2**attempt) seconds
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 30
+# Seconds after which safe_telegram_request stops retrying a call
+REQUEST_DEADLINE = 60
+# Retries shared by all requests: burst capacity and refill per second
+RETRY_BUDGET_CAPACITY = 20
+RETRY_BUDGET_RATE = 0.5
+# 1win verification API, point it at stub_1win.py for local runs
+ONEWIN_API_URL = os.getenv("ONEWIN_API_URL", "https://api.1win.com").rstrip("/")
+# Background verification of users who have not registered or deposited yet:
+# seconds between runs, users checked per stage and run, concurrent API calls
+VERIFY_POLL_INTERVAL = int(os.getenv("VERIFY_POLL_INTERVAL", "300"))
+VERIFY_POLL_BATCH = int(os.getenv("VERIFY_POLL_BATCH", "200"))
+VERIFY_POLL_CONCURRENCY = int(os.getenv("VERIFY_POLL_CONCURRENCY", "8"))
+# Users who joined more than this many days ago are no longer polled
+VERIFY_POLL_MAX_AGE_DAYS = int(os.getenv("VERIFY_POLL_MAX_AGE_DAYS", "7"))
+# Promoted users listed per stage in the poller's admin summary
+VERIFY_REPORT_MAX_LINES = 50
+# Seconds a 1win verification result is reused, confirmations are kept much longer than misses
+VERIFY_POSITIVE_TTL = 3600
+VERIFY_NEGATIVE_TTL = int(os.getenv("VERIFY_NEGATIVE_TTL", "30"))
+# Workers sending the messages that follow postbacks, they queue in the outbox bulk lane
+POSTBACK_SEND_WORKERS = 4
+# Seconds to wait for the remaining parts of an album sent for broadcast
+ALBUM_COLLECT_DELAY = 1.5
+BROADCAST_PROMPT = "📨 Send or forward the message to broadcast: text, photo, video, document or an album."
 
 # Initialize logging
 logging.basicConfig(
@@ -32,52 +81,51 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Language helper functions
-def get_user_language(user_id):
-    """Get user's language preference from users.json"""
-    filename = "users.json"
-    try:
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                users = json.load(f)
-            for user in users:
-                if user['id'] == user_id:
-                    return user.get('language', 'en')
-        return 'en'
-    except Exception as e:
-        logger.error(f"Error getting user language: {e}")
-        return 'en'
+class UserRecord(dict):
+    """A user's row loaded once per update, remembers which fields handlers changed"""
+
+    def __init__(self, user_id, row=None):
+        super().__init__(row or {'id': user_id, **NEW_USER_DEFAULTS})
+        self.exists = row is not None
+        self.dirty = set()
+
+    def __setitem__(self, key, value):
+        # Any field set on a new user is written so the row gets created
+        if not self.exists or self.get(key) != value:
+            self.dirty.add(key)
+        super().__setitem__(key, value)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+def context_user_record(context, user_id):
+    """Return the record loaded for this update if it belongs to user_id"""
+    user_record = getattr(context, 'user_record', None)
+    if user_record is not None and user_record['id'] == user_id:
+        return user_record
+    return None
 
-def set_user_language(user_id, lang_code):
-    """Set user's language preference in users.json"""
-    filename = "users.json"
-    try:
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                users = json.load(f)
-        else:
-            users = []
-            
-        user_found = False
-        for user in users:
-            if user['id'] == user_id:
-                user['language'] = lang_code
-                user_found = True
-                break
-                
-        if not user_found:
-            users.append({
-                "id": user_id,
-                "username": "",
-                "registered": 0,
-                "deposited": 0,
-                "language": lang_code
-            })
-            
-        with open(filename, 'w') as f:
-            json.dump(users, f, indent=2)
-    except Exception as e:
-        logger.error(f"Error setting user language: {e}")
+async def load_user_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Load the user's record once per update before any handler runs"""
+    context.user_record = None
+    if update.effective_user is None:
+        return
+    user_id = update.effective_user.id
+    context.user_record = UserRecord(user_id, await run_db(get_user_record, user_id))
+
+async def save_user_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Write the fields changed by the handler back in a single statement"""
+    user_record = getattr(context, 'user_record', None)
+    if user_record is None or not user_record.dirty:
+        return
+    changes = {key: user_record[key] for key in user_record.dirty}
+    if user_record.exists:
+        await run_db(update_user_fields, user_record['id'], **changes)
+    else:
+        await run_db(upsert_user, user_record['id'], **changes)
+        user_record.exists = True
+    user_record.dirty.clear()
 
 async def send_admin_notification(message_type: str, user_id: int, country: str = "", amount: float = 0.0):
     """Send notifications to admin using Telegram API with timestamps"""
@@ -96,47 +144,106 @@ async def send_admin_notification(message_type: str, user_id: int, country: str
         return
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(base_url, params=params) as response:
-                if response.status != 200:
-                    response_text = await response.text()
-                    logger.error(f"Failed to send admin notification: {response.status} - {response_text}")
+        async with http_client.session().get(base_url, params=params) as response:
+            if response.status != 200:
+                response_text = await response.text()
+                logger.error(f"Failed to send admin notification: {response.status} - {response_text}")
     except Exception as e:
         logger.error(f"Error sending admin notification: {e}")
 
-async def safe_telegram_request(func, *args, max_retries=5, timeout=30, **kwargs):
-    """Wrapper for Telegram API requests with retry logic and timeout"""
+class RetryBudget:
+    """Retries shared by every request, refilled at `rate` per second up to `capacity`.
+
+    During a Telegram incident the budget runs dry and requests fail fast
+    instead of multiplying the load with retries.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATE, RETRY_BUDGET_CAPACITY)
+# Counters of the retry engine, shown in /status
+retry_stats = {'retries': 0, 'backoff_seconds': 0.0, 'gave_up': 0, 'budget_exhausted': 0}
+
+async def safe_telegram_request(func, *args, max_retries=5, timeout=30, deadline=REQUEST_DEADLINE, **kwargs):
+    """Wrapper for Telegram API requests with retry logic and timeout.
+
+    Retries RetryAfter after the requested delay and conflicts, timeouts and
+    network errors with full-jitter exponential backoff, without blocking the
+    event loop. Gives up with the last error once max_retries, the per-call
+    deadline or the shared retry budget is used up.
+    """
+    give_up_at = time.monotonic() + deadline
     for attempt in range(max_retries):
         try:
             # Use asyncio's timeout to prevent hanging requests
             return await asyncio.wait_for(func(*args, **kwargs), timeout)
-        except Conflict as e:
-            logger.warning(f"Conflict detected (attempt {attempt+1}/{max_retries}): {e}")
-            if attempt == max_retries - 1:
-                raise
-            backoff = 2 ** attempt
-            time.sleep(backoff)
         except RetryAfter as e:
-            retry_after = e.retry_after
-            logger.warning(f"Rate limited. Retrying after {retry_after} seconds")
-            time.sleep(retry_after)
-        except TimedOut as e:
-            logger.warning(f"Timeout detected (attempt {attempt+1}/{max_retries}): {e}")
-            if attempt == max_retries - 1:
-                raise
-            backoff = 2 ** attempt
-            time.sleep(backoff)
-        except asyncio.TimeoutError as e:
-            logger.warning(f"Request timed out (attempt {attempt+1}/{max_retries}): {e}")
-            if attempt == max_retries - 1:
-                raise TimedOut("Request timed out") from e
-            backoff = 2 ** attempt
-            time.sleep(backoff)
-    return None
+            error, delay = e, e.retry_after
+        except BadRequest:
+            # A BadRequest is a NetworkError too, but retrying it cannot help
+            raise
+        except (Conflict, NetworkError) as e:
+            # TimedOut is a NetworkError
+            error, delay = e, random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        except asyncio.TimeoutError:
+            error = TimedOut("Request timed out")
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+        if attempt == max_retries - 1 or time.monotonic() + delay > give_up_at:
+            retry_stats['gave_up'] += 1
+            raise error
+        if not retry_budget.take():
+            retry_stats['budget_exhausted'] += 1
+            logger.warning(f"Retry budget exhausted, not retrying {getattr(func, '__name__', func)}: {error}")
+            raise error
+        logger.warning(f"{type(error).__name__} (attempt {attempt+1}/{max_retries}), retrying in {delay:.1f}s: {error}")
+        retry_stats['retries'] += 1
+        retry_stats['backoff_seconds'] += delay
+        await asyncio.sleep(delay)
+
+async def store_deposit_message_id(context, user_id, message_id):
+    """Remember the deposit message on the update's record, or write it directly for other users"""
+    user_record = context_user_record(context, user_id)
+    if user_record is not None:
+        user_record['deposit_message_id'] = message_id
+    else:
+        await run_db(update_deposit_message_id, user_id, message_id)
 
-async def send_deposit_message(chat_id, user_id, context):
-    """Send deposit message with image and buttons after registration"""
-    user_lang = get_user_language(user_id)
+async def send_deposit_photo(context, chat_id, **kwargs):
+    """Send deposit.jpg, it is uploaded once and then resent by file_id"""
+    global deposit_photo_file_id
+    if deposit_photo_file_id:
+        try:
+            return await safe_telegram_request(context.bot.send_photo, chat_id=chat_id, photo=deposit_photo_file_id, **kwargs)
+        except BadRequest as e:
+            # Telegram no longer knows the file, upload it again
+            logger.warning(f"Resending deposit photo by file_id failed: {e}")
+            deposit_photo_file_id = None
+    with open('deposit.jpg', 'rb') as photo_file:
+        message = await safe_telegram_request(context.bot.send_photo, chat_id=chat_id, photo=photo_file, **kwargs)
+    deposit_photo_file_id = message.photo[-1].file_id
+    return message
+
+async def send_deposit_message(chat_id, user_id, context, user_lang=None, lane=None):
+    """Send deposit message with image and buttons after registration, optionally in an outbox lane"""
+    user_record = context_user_record(context, user_id)
+    if user_lang is None:
+        if user_record is None:
+            user_record = await run_db(get_user_record, user_id)
+        user_lang = user_record['language'] if user_record else 'en'
     
     # Define translations for deposit text
     translations = {
@@ -175,257 +282,88 @@ async def send_deposit_message(chat_id, user_id, context):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
+    rate_limit_args = {'lane': lane} if lane else None
     try:
-        with open('deposit.jpg', 'rb') as photo_file:
-            try:
-                message = await safe_telegram_request(
-                    context.bot.send_photo,
-                    chat_id=chat_id,
-                    photo=photo_file,
-                    caption=lang_data['caption'],
-                    reply_markup=reply_markup
-                )
-                # Store deposit message ID in database
-                from database import update_deposit_message_id
-                update_deposit_message_id(user_id, message.message_id)
-            except Exception as e:
-                logger.error(f"Error sending deposit photo: {e}. Falling back to text.")
-                # Fallback to text message if photo sending fails
-                message = await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=lang_data['caption'],
-                    reply_markup=reply_markup
-                )
-                # Store deposit message ID in database
-                from database import update_deposit_message_id
-                update_deposit_message_id(user_id, message.message_id)
+        message = await send_deposit_photo(
+            context,
+            chat_id,
+            caption=lang_data['caption'],
+            reply_markup=reply_markup,
+            rate_limit_args=rate_limit_args
+        )
     except FileNotFoundError:
-        message = await context.bot.send_message(
+        message = None
+    except Exception as e:
+        logger.error(f"Error sending deposit photo: {e}. Falling back to text.")
+        message = None
+    if message is None:
+        # Fallback to text message if photo sending fails
+        message = await safe_telegram_request(
+            context.bot.send_message,
             chat_id=chat_id,
             text=lang_data['caption'],
-            reply_markup=reply_markup
+            reply_markup=reply_markup,
+            rate_limit_args=rate_limit_args
         )
-        # Store deposit message ID in database
-        from database import update_deposit_message_id
-        update_deposit_message_id(user_id, message.message_id)
-
-def add_user_to_json(user_id, username):
-    """Add user to users.json with status tracking"""
-    filename = "users.json"
-    try:
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                users = json.load(f)
-        else:
-            users = []
-            
-        # Check if user exists, update if found
-        user_exists = False
-        for user in users:
-            if user['id'] == user_id:
-                user_exists = True
-                # Update username if changed
-                user['username'] = username
-                break
-                
-        if not user_exists:
-            users.append({
-                "id": user_id,
-                "username": username,
-                "registered": 0,
-                "deposited": 0,
-                "admin_approved": 0  # NEW FIELD
-            })
-            
-        with open(filename, 'w') as f:
-            json.dump(users, f, indent=2)
-            
-    except Exception as e:
-        logger.error(f"Error updating users.json: {e}")
-        
-        with open(filename, 'w') as f:
-            json.dump(users, f, indent=2)
-            
-    except Exception as e:
-        logger.error(f"Error updating users.json: {e}")
-
-def update_user_status_in_json(user_id, registered=None, deposited=None, country=None, amount=None):
-    """Update user status in users.json with timestamps"""
-    filename = "users.json"
-    try:
-        if not os.path.exists(filename):
-            return
-            
-        with open(filename, 'r') as f:
-            users = json.load(f)
-            
-        user_found = False
-        for user in users:
-            if user['id'] == user_id:
-                if registered is not None:
-                    user['registered'] = 1 if registered else 0
-                    user['registration_time'] = datetime.now().isoformat()
-                if deposited is not None:
-                    user['deposited'] = 1 if deposited else 0
-                    user['deposit_time'] = datetime.now().isoformat()
-                if country:
-                    user['country'] = country
-                if amount is not None:
-                    user['amount'] = amount
-                user['admin_approved'] = user.get('admin_approved', 0)
-                user_found = True
-                break
-                
-        if not user_found:
-            new_user = {
-                "id": user_id,
-                "username": "",
-                "admin_approved": 0,
-                "last_signal_message_id": 0
-            }
-            if registered is not None:
-                new_user['registered'] = 1 if registered else 0
-                new_user['registration_time'] = datetime.now().isoformat()
-            if deposited is not None:
-                new_user['deposited'] = 1 if deposited else 0
-                new_user['deposit_time'] = datetime.now().isoformat()
-            if country:
-                new_user['country'] = country
-            if amount is not None:
-                new_user['amount'] = amount
-                
-            users.append(new_user)
-                
-        with open(filename, 'w') as f:
-            json.dump(users, f, indent=2)
-            
-    except Exception as e:
-        logger.error(f"Error updating user status in JSON: {e}")
-
-def update_user_last_signal_message(user_id, message_id):
-    """Update last signal message ID in users.json"""
-    filename = "users.json"
-    try:
-        if not os.path.exists(filename):
-            return
-            
-        with open(filename, 'r') as f:
-            users = json.load(f)
-            
-        for user in users:
-            if user['id'] == user_id:
-                user['last_signal_message_id'] = message_id
-                break
-                
-        with open(filename, 'w') as f:
-            json.dump(users, f, indent=2)
-    except Exception as e:
-        logger.error(f"Error updating last signal message ID: {e}")
-
-def get_user_last_signal_message(user_id):
-    """Get last signal message ID from users.json"""
-    filename = "users.json"
-    try:
-        if not os.path.exists(filename):
-            return 0
-            
-        with open(filename, 'r') as f:
-            users = json.load(f)
-            
-        for user in users:
-            if user['id'] == user_id:
-                return user.get('last_signal_message_id', 0)
-        return 0
-    except Exception as e:
-        logger.error(f"Error getting last signal message ID: {e}")
-        return 0
+    # Store deposit message ID in database
+    await store_deposit_message_id(context, user_id, message.message_id)
 
-def update_user_admin_approved(user_id, approved):
-    """Update admin_approved status in users.json"""
-    filename = "users.json"
-    try:
-        if not os.path.exists(filename):
-            return
-            
-        with open(filename, 'r') as f:
-            users = json.load(f)
-            
-        user_found = False
-        for user in users:
-            if user['id'] == user_id:
-                user['admin_approved'] = 1 if approved else 0
-                user_found = True
-                break
-                
-        if not user_found:
-            users.append({
-                "id": user_id,
-                "username": "",
-                "registered": 0,
-                "deposited": 0,
-                "admin_approved": 1 if approved else 0
-            })
-                
-        with open(filename, 'w') as f:
-            json.dump(users, f, indent=2)
-            
-    except Exception as e:
-        logger.error(f"Error updating admin approval status: {e}")
+# file_id of deposit.jpg once Telegram has stored it
+deposit_photo_file_id = None
 
+# (kind, user_id) -> (expires_at, result) of recent verifications, and the requests in flight
+_verify_cache = {}
+_verify_inflight = {}
 
-def check_user_status(user_id):
-    """Check user status from users.json"""
-    filename = "users.json"
-    try:
-        if not os.path.exists(filename):
-            return None
-            
-        with open(filename, 'r') as f:
-            users = json.load(f)
-            
-        for user in users:
-            if user['id'] == user_id:
-                return {
-                    'registered': user.get('registered', 0),
-                    'deposited': user.get('deposited', 0),
-                    'admin_approved': user.get('admin_approved', 0)
-                }
-                
-        return None
-    except Exception as e:
-        logger.error(f"Error checking user status: {e}")
-        return None
+def _store_verification(key, task, confirmed):
+    _verify_inflight.pop(key, None)
+    if task.cancelled() or task.exception() is not None:
+        return
+    result = task.result()
+    now = time.monotonic()
+    ttl = VERIFY_POSITIVE_TTL if confirmed(result) else VERIFY_NEGATIVE_TTL
+    _verify_cache[key] = (now + ttl, result)
+    # Drop expired entries now and then so the cache only holds recent users
+    if len(_verify_cache) % 1000 == 0:
+        for stale in [k for k, (expires_at, _) in _verify_cache.items() if expires_at <= now]:
+            del _verify_cache[stale]
+
+async def cached_verification(kind, user_id, fetch, confirmed):
+    """Return a recent result of fetch(user_id), concurrent checks for one user share one request"""
+    key = (kind, user_id)
+    cached = _verify_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    task = _verify_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch(user_id))
+        _verify_inflight[key] = task
+        task.add_done_callback(lambda task: _store_verification(key, task, confirmed))
+    # A caller giving up must not cancel the request the others are waiting for
+    return await asyncio.shield(task)
 
+async def verify_registration(user_id):
+    """Verify user registration with external API, results are cached"""
+    return await cached_verification('registration', user_id, fetch_registration, bool)
 
-def get_all_user_ids():
-    """Get all user IDs from users.json"""
-    filename = "users.json"
-    try:
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                users = json.load(f)
-                return [u['id'] for u in users]
-        return []
-    except Exception as e:
-        logger.error(f"Error reading users.json: {e}")
-        return []
+async def verify_deposit(user_id):
+    """Verify user deposit with external API, results are cached"""
+    return await cached_verification('deposit', user_id, fetch_deposit, lambda result: result[0])
 
-async def verify_registration(user_id):
+async def fetch_registration(user_id):
     """Verify user registration with external API"""
     try:
-        timeout = aiohttp.ClientTimeout(total=10)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(f"https://api.1win.com/verify-registration/{user_id}") as response:
-                if response.status == 200:
-                    try:
-                        data = await response.json()
-                        return data.get("registered", False)
-                    except aiohttp.ContentTypeError:
-                        response_text = await response.text()
-                        logger.error(f"Invalid JSON response: {response_text}")
-                        return False
-                else:
-                    logger.error(f"API returned status {response.status} for user {user_id}")
+        async with http_client.session().get(f"{ONEWIN_API_URL}/verify-registration/{user_id}") as response:
+            if response.status == 200:
+                try:
+                    data = await response.json()
+                    return data.get("registered", False)
+                except aiohttp.ContentTypeError:
+                    response_text = await response.text()
+                    logger.error(f"Invalid JSON response: {response_text}")
+                    return False
+            else:
+                logger.error(f"API returned status {response.status} for user {user_id}")
         return False
     except asyncio.TimeoutError:
         logger.error("Registration verification timed out")
@@ -434,22 +372,20 @@ async def verify_registration(user_id):
         logger.error(f"Registration verification failed: {e}")
         return False
 
-async def verify_deposit(user_id):
+async def fetch_deposit(user_id):
     """Verify user deposit with external API"""
     try:
-        timeout = aiohttp.ClientTimeout(total=10)
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.get(f"https://api.1win.com/verify-deposit/{user_id}") as response:
-                if response.status == 200:
-                    try:
-                        data = await response.json()
-                        return data.get("deposited", False), data.get("amount", 0.0)
-                    except aiohttp.ContentTypeError:
-                        response_text = await response.text()
-                        logger.error(f"Invalid JSON response: {response_text}")
-                        return False, 0.0
-                else:
-                    logger.error(f"API returned status {response.status} for user {user_id}")
+        async with http_client.session().get(f"{ONEWIN_API_URL}/verify-deposit/{user_id}") as response:
+            if response.status == 200:
+                try:
+                    data = await response.json()
+                    return data.get("deposited", False), data.get("amount", 0.0)
+                except aiohttp.ContentTypeError:
+                    response_text = await response.text()
+                    logger.error(f"Invalid JSON response: {response_text}")
+                    return False, 0.0
+            else:
+                logger.error(f"API returned status {response.status} for user {user_id}")
         return False, 0.0
     except asyncio.TimeoutError:
         logger.error("Deposit verification timed out")
@@ -458,47 +394,214 @@ async def verify_deposit(user_id):
         logger.error(f"Deposit verification failed: {e}")
         return False, 0.0
 
+def import_users_json():
+    """Import users.json into the users table once, before the first sync mirrors the table back.
+
+    Until the mirror has a watermark, users.json may hold users and fields
+    (language, admin approval, last signal) that the table has never seen.
+    """
+    if get_sync_watermark(USERS_JSON_SYNC) is not None:
+        return 0
+    records = user_store.all_records()
+    if records:
+        imported = database.import_users(records)
+        logger.info(f"Imported {imported} users from {user_store.USERS_FILE} into the database")
+    return len(records)
+
+def merge_into_users_json(records):
+    """Merge user records into the users.json mirror field by field"""
+    # Field by field merge keeps anything only the mirror knows about
+    for record in records:
+        fields = {key: value for key, value in record.items() if key != 'id'}
+        user_store.update_record(record['id'], defaults={}, **fields)
+
 def sync_databases():
-    """Synchronize SQLite and JSON databases"""
+    """Merge users changed since the last run into the users.json mirror.
+
+    Returns the number of users merged, or None if the sync failed.
+    """
     try:
-        # Sync from SQLite to JSON
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT id, username, registered, deposited FROM users')
-        db_users = c.fetchall()
-        conn.close()
+        watermark = get_sync_watermark(USERS_JSON_SYNC)
+        if watermark is None:
+            # First run merges the whole table once, users only the mirror knows about are kept
+            records, seq = snapshot_user_records()
+            merge_into_users_json(records)
+            set_sync_watermark(USERS_JSON_SYNC, seq)
+            return len(records)
         
-        json_users = []
-        for user in db_users:
-            json_users.append({
-                "id": user[0],
-                "username": user[1],
-                "registered": user[2],
-                "deposited": user[3],
-                "admin_approved": 0
-            })
-        
-        with open('users.json', 'w') as f:
-            json.dump(json_users, f, indent=2)
-            
-        return True
+        synced = 0
+        while True:
+            records, last_seq = get_changed_user_records(watermark)
+            if last_seq == watermark:
+                break
+            merge_into_users_json(records)
+            set_sync_watermark(USERS_JSON_SYNC, last_seq)
+            watermark = last_seq
+            synced += len(records)
+        return synced
     except Exception as e:
         logger.error(f"Database sync failed: {e}")
-        return False
+        return None
+
+async def sync_databases_job(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically mirror changed users into users.json"""
+    synced = await run_db(sync_databases)
+    if synced:
+        logger.info(f"Synced {synced} changed users to users.json")
+    if user_store.needs_compaction():
+        await asyncio.to_thread(user_store.compact)
+
+async def poll_registration(context, user_id):
+    """Verify a pending registration, send the deposit instructions once confirmed.
+
+    Returns the admin summary line of a promoted user, None otherwise.
+    """
+    if not await verify_registration(user_id):
+        return None
+    # Only the first to record the registration (a button check, a postback or this poll) messages the user
+    registered, _ = await run_db(apply_funnel_events, [user_id], {})
+    if not registered:
+        return None
+    await send_deposit_message(chat_id=user_id, user_id=user_id, context=context, lane='bulk')
+    return f"✅ {user_id}"
+
+async def poll_deposit(context, user_id):
+    """Verify a pending deposit, mark the user VIP and open access to signals once confirmed.
+
+    Returns the admin summary line of a promoted user, None otherwise.
+    """
+    deposited, amount = await verify_deposit(user_id)
+    if not deposited:
+        return None
+    _, deposited = await run_db(apply_funnel_events, [], {user_id: amount})
+    if not deposited:
+        return None
+    user_record = await run_db(get_user_record, user_id)
+    await send_access_message(user_id, context, user_record['language'], lane='bulk')
+    return f"💰 {user_id}:{user_record['country'] or ''}:{amount}"
+
+# Pending stage -> (segment filters, check that promotes a verified user)
+VERIFY_POLL_STAGES = {
+    'registration': ({'registered': False}, poll_registration),
+    'deposit': ({'registered': True, 'deposited': False}, poll_deposit),
+}
+
+async def poll_pending_stage(context, stage, semaphore):
+    """Verify the next batch of users waiting in a stage, returns the summary lines of those promoted"""
+    filters, poll = VERIFY_POLL_STAGES[stage]
+    cursors = context.bot_data.setdefault('verify_poll_cursors', {})
+    joined_after = (datetime.now() - timedelta(days=VERIFY_POLL_MAX_AGE_DAYS)).isoformat()
+    user_ids = await run_db(get_user_id_page, VERIFY_POLL_BATCH, after_id=cursors.get(stage),
+                            joined_after=joined_after, **filters)
+    # Start over from the lowest id once the end of the stage is reached
+    cursors[stage] = user_ids[-1] if len(user_ids) == VERIFY_POLL_BATCH else None
+
+    async def check(user_id):
+        async with semaphore:
+            try:
+                return await poll(context, user_id)
+            except Exception as e:
+                logger.error(f"Error promoting user {user_id} after {stage} verification: {e}")
+                return None
+
+    return [line for line in await asyncio.gather(*(check(user_id) for user_id in user_ids)) if line]
+
+async def verify_pending_users_job(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically verify users who have not registered or deposited yet and move them on"""
+    semaphore = asyncio.Semaphore(VERIFY_POLL_CONCURRENCY)
+    report = []
+    for stage in VERIFY_POLL_STAGES:
+        promoted = await poll_pending_stage(context, stage, semaphore)
+        if promoted:
+            logger.info(f"Verification poller confirmed {stage} of {len(promoted)} users")
+            report.append(f"{stage.capitalize()}s confirmed: {len(promoted)}")
+            report.extend(promoted[:VERIFY_REPORT_MAX_LINES])
+            if len(promoted) > VERIFY_REPORT_MAX_LINES:
+                report.append(f"… and {len(promoted) - VERIFY_REPORT_MAX_LINES} more")
+    # One summary per run instead of a notification per user
+    if report:
+        try:
+            await safe_telegram_request(
+                context.bot.send_message,
+                chat_id=ADMIN_ID,
+                text=f"🔎 Verification poller at {datetime.now():%Y-%m-%d %H:%M}\n" + "\n".join(report)
+            )
+        except Exception as e:
+            logger.error(f"Error sending verification poller report: {e}")
+
+# (user_id, deposited) of promoted users waiting for their follow-up message, and the workers sending them
+postback_followups = None
+postback_workers = []
+
+async def send_postback_followup(context, user_id, deposited):
+    """Send the deposit instructions or the access message for a confirmed postback"""
+    try:
+        if deposited:
+            user_record = await run_db(get_user_record, user_id)
+            await send_access_message(user_id, context, user_record['language'], lane='bulk')
+        else:
+            await send_deposit_message(chat_id=user_id, user_id=user_id, context=context, lane='bulk')
+    except Exception as e:
+        logger.error(f"Error sending postback follow-up to user {user_id}: {e}")
+
+async def postback_followup_worker(context):
+    while True:
+        user_id, deposited = await postback_followups.get()
+        try:
+            await send_postback_followup(context, user_id, deposited)
+        finally:
+            postback_followups.task_done()
+
+def start_postback_workers(application):
+    """Start the workers sending postback follow-ups"""
+    global postback_followups
+    postback_followups = asyncio.Queue()
+    context = CallbackContext(application)
+    postback_workers[:] = [
+        asyncio.create_task(postback_followup_worker(context)) for _ in range(POSTBACK_SEND_WORKERS)
+    ]
+
+async def stop_postback_workers(timeout=10):
+    """Send the queued postback follow-ups, then stop the workers"""
+    if postback_followups is None:
+        return
+    try:
+        await asyncio.wait_for(postback_followups.join(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Postback follow-ups not sent before shutdown: {postback_followups.qsize()}")
+    for worker in postback_workers:
+        worker.cancel()
+    postback_workers.clear()
+
+async def apply_postbacks(events):
+    """Record a batch of 1win postbacks and queue messages for the users who moved on"""
+    registered_ids = [event['user_id'] for event in events if event['event'] == 'registration']
+    deposits = {event['user_id']: event['amount'] for event in events if event['event'] == 'deposit'}
+    registered, deposited = await run_db(apply_funnel_events, registered_ids, deposits)
+    if registered or deposited:
+        logger.info(f"Postbacks confirmed {len(registered)} registrations and {len(deposited)} deposits")
+    # Users who registered and deposited within one batch only need the access message
+    deposited = set(deposited)
+    for user_id in registered:
+        if user_id not in deposited:
+            postback_followups.put_nowait((user_id, False))
+    for user_id in deposited:
+        postback_followups.put_nowait((user_id, True))
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    user_record = get_user(user.id)
+    user_record = context.user_record
     
-    # Add/update user in JSON file
-    add_user_to_json(user.id, user.username)
+    # Create the user on first contact, keep the username current
+    user_record['username'] = user.username
     
-    # Initialize status fields if new user
-    if not user_record:
-        update_user_status_in_json(user_id=user.id, registered=False, deposited=False)
+    # A user coming back is reachable again, clear any broadcast tombstone
+    if user_record['blocked']:
+        logger.info(f"Clearing {user_record['blocked_reason']} tombstone for returning user {user.id}")
+        user_record.update(blocked=0, blocked_reason=None, blocked_at=None)
     
     # Get user's language
-    user_lang = get_user_language(user.id)
+    user_lang = user_record['language']
     
     # Define translations for the main menu
     translations = {
@@ -551,7 +654,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
     except FileNotFoundError:
         logger.error("main.jpg file not found")
-        await context.bot.send_message(
+        await safe_telegram_request(
+            context.bot.send_message,
             chat_id=update.effective_chat.id,
             text=lang_data['caption'],
             parse_mode="Markdown",
@@ -592,8 +696,8 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     # Continue with handler logic
     user_id = query.from_user.id
-    user_record = get_user(user_id)
-    user_lang = get_user_language(user_id)
+    user_record = context.user_record
+    user_lang = user_record['language']
     
     # Define translations for registration text
     translations = {
@@ -624,17 +728,13 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Default to English if language not found
     lang_data = translations.get(user_lang, translations['en'])
     
-    # Check user status using JSON data
-    status = check_user_status(user_id)
-    if status is None:
-        # If status not found, treat as unregistered
-        status = {'registered': 0, 'deposited': 0}
+    # Check user status, unknown users are treated as unregistered
+    status = user_record
 
     if status['registered'] == 0:  # Not registered
         # Create user if not exists
-        if not user_record:
-            create_user(user_id, query.from_user.username)
-            user_record = get_user(user_id)
+        if not user_record.exists:
+            user_record['username'] = query.from_user.username
         
         # Create inline keyboard with registration link, check registration button, and back button
         keyboard = [
@@ -656,7 +756,8 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
         except FileNotFoundError:
             # Fallback to text if image not found
-            await context.bot.send_message(
+            await safe_telegram_request(
+                context.bot.send_message,
                 chat_id=query.message.chat_id,
                 text=lang_data['caption'],
                 reply_markup=reply_markup
@@ -664,7 +765,8 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.error(f"Error sending registration photo: {e}. Falling back to text.")
             # Fallback to text message if photo sending fails
-            await context.bot.send_message(
+            await safe_telegram_request(
+                context.bot.send_message,
                 chat_id=query.message.chat_id,
                 text=lang_data['caption'],
                 reply_markup=reply_markup
@@ -674,7 +776,8 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_deposit_message(
             chat_id=query.message.chat_id,
             user_id=user_id,
-            context=context
+            context=context,
+            user_lang=user_lang
         )
     else:  # Both registered and deposited
         # Use multilingual response
@@ -682,7 +785,6 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'en': "✅ Your deposit has been successfully verified! Access to signals is now open.",
             'hi': "✅ आपकी जमा राशि सफलतापूर्वक सत्यापित हो गई है! सिग्नल तक पहुंच अब खुली है।"
         }
-        user_lang = get_user_language(user_id)
         message_text = translations.get(user_lang, translations['en'])
         
         keyboard = [
@@ -691,13 +793,37 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await context.bot.send_message(
+        await safe_telegram_request(
+            context.bot.send_message,
             chat_id=query.message.chat_id,
             text=message_text,
             reply_markup=reply_markup
         )
 
 
+async def send_access_message(chat_id, context, user_lang, lane=None):
+    """Tell a user their deposit is verified and open the signals web app, optionally in an outbox lane"""
+    # Define translations for deposit success text
+    translations = {
+        'en': "✅ Your deposit has been successfully verified! Access to signals is now open.",
+        'hi': "✅ आपकी जमा राशि सफलतापूर्वक सत्यापित हो गई है! सिग्नल तक पहुंच अब खुली है।"
+    }
+    message_text = translations.get(user_lang, translations['en'])
+    
+    keyboard = [
+        [InlineKeyboardButton("⚜️ Get Signal", web_app=WebAppInfo(url="https://feedox-ai-software-zdwq.vercel.app/"))],
+        [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await safe_telegram_request(
+        context.bot.send_message,
+        chat_id=chat_id,
+        text=message_text,
+        reply_markup=reply_markup,
+        rate_limit_args={'lane': lane} if lane else None
+    )
+
 async def check_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -712,22 +838,23 @@ async def check_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Get user country from Telegram (approximation)
     country = query.from_user.language_code if query.from_user.language_code else "unknown"
     
-    # Get actual deposit amount from database
-    from database import get_deposit_amount
-    amount = get_deposit_amount(user_id) or 0.0
+    # Get actual deposit amount and language from database
+    user_record = context.user_record
+    amount = user_record['amount'] or 0.0
+    user_lang = user_record['language']
     
     # Send deposit notification to admin using Telegram API link
     try:
         await send_admin_notification("deposit", user_id, country, amount)
         # Mark user as VIP
-        mark_deposited(user_id)
+        user_record.update(deposited=1, vip=1, status="VIP")
         
         # Delete previous deposit instruction
-        from database import get_deposit_message_id
-        deposit_message_id = get_deposit_message_id(user_id)
+        deposit_message_id = user_record['deposit_message_id']
         if deposit_message_id:
             try:
-                await context.bot.delete_message(
+                await safe_telegram_request(
+                    context.bot.delete_message,
                     chat_id=query.message.chat_id,
                     message_id=deposit_message_id
                 )
@@ -735,25 +862,7 @@ async def check_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 logger.error(f"Error deleting deposit message: {e}")
         
         # Send deposit confirmation
-        # Define translations for deposit success text
-        user_lang = get_user_language(user_id)
-        translations = {
-            'en': "✅ Your deposit has been successfully verified! Access to signals is now open.",
-            'hi': "✅ आपकी जमा राशि सफलतापूर्वक सत्यापित हो गई है! सिग्नल तक पहुंच अब खुली है।"
-        }
-        message_text = translations.get(user_lang, translations['en'])
-        
-        keyboard = [
-            [InlineKeyboardButton("⚜️ Get Signal", web_app=WebAppInfo(url="https://feedox-ai-software-zdwq.vercel.app/"))],
-            [InlineKeyboardButton("🔙 Back to Main Menu", callback_data="back_to_main")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=message_text,
-            reply_markup=reply_markup
-        )
+        await send_access_message(query.message.chat_id, context, user_lang)
     except Exception as e:
         logger.error(f"Deposit verification failed: {e}")
         await query.message.reply_text("⚠️ An error occurred. Please try again later.")
@@ -767,20 +876,23 @@ async def check_registration_callback(update: Update, context: ContextTypes.DEFA
         logger.error(f"Error deleting message: {e}")
     
     user_id = query.from_user.id
-    user_lang = get_user_language(user_id)
+    user_record = context.user_record
+    user_lang = user_record['language']
     
-    # Verify registration with external API
-    registered = await verify_registration(user_id)
+    # Verify registration with external API, confirmed users are never checked again
+    registered = user_record['registered'] or await verify_registration(user_id)
     
     if registered:
         # Update user status with registration timestamp
-        update_user_status_in_json(user_id, registered=True)
+        if not user_record['registered']:
+            user_record.update(registered=1, registration_time=datetime.now().isoformat())
         
         # Send deposit instructions
         await send_deposit_message(
             chat_id=query.message.chat_id,
             user_id=user_id,
-            context=context
+            context=context,
+            user_lang=user_lang
         )
     else:
         # Registration not complete
@@ -796,7 +908,8 @@ async def check_registration_callback(update: Update, context: ContextTypes.DEFA
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await context.bot.send_message(
+        await safe_telegram_request(
+            context.bot.send_message,
             chat_id=query.message.chat_id,
             text=message_text,
             reply_markup=reply_markup
@@ -810,10 +923,10 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Error deleting message: {e}")
     user_id = query.from_user.id
-    user = get_user(user_id)
+    user = context.user_record
     
-    if user:
-        status = user[3]  # status field
+    if user.exists:
+        status = user['status']
         text = f"👤 Profile\n\nName: {query.from_user.full_name}\nID: {user_id}\nStatus: {status}"
         await query.message.reply_text(text)
     else:
@@ -829,7 +942,8 @@ async def instruction(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     # Continue with handler logic
     user_id = query.from_user.id
-    user_lang = get_user_language(user_id)
+    user_record = context.user_record
+    user_lang = user_record['language']
     
     # Define translations for instruction text
     translations = {
@@ -885,7 +999,8 @@ To achieve maximum profit, follow this instruction:
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     # Send a new message with instructions and back button
-    await context.bot.send_message(
+    await safe_telegram_request(
+        context.bot.send_message,
         chat_id=query.message.chat_id,
         text=instruction_text,
         reply_markup=reply_markup
@@ -939,10 +1054,9 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
     
     # Extract language code from callback_data (remove 'lang_' prefix)
     lang_code = query.data.split('_')[1]
-    user_id = query.from_user.id
     
     # Update user's language in database
-    set_user_language(user_id, lang_code)
+    context.user_record['language'] = lang_code
     
     # Translation dictionary
     translations = {
@@ -958,7 +1072,7 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
     
     # Get translation for selected language
     lang_data = translations.get(lang_code, translations['en'])
-    await context.bot.send_message(chat_id=query.message.chat_id, text=lang_data['confirmation'])
+    await safe_telegram_request(context.bot.send_message, chat_id=query.message.chat_id, text=lang_data['confirmation'])
     
     # Show main menu in selected language
     await start(update, context)
@@ -978,8 +1092,8 @@ async def get_signal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Continue with handler logic
     user_id = query.from_user.id
-    user = get_user(user_id)
-    user_lang = get_user_language(user_id)
+    user = context.user_record
+    user_lang = user['language']
     
     # Define translations dictionary for all states
     translations = {
@@ -1020,11 +1134,8 @@ async def get_signal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Error deleting message: {e}")
     
-    # Handle different user states based on status
-    status = check_user_status(user_id)
-    if status is None:
-        # User not found - treat as unregistered
-        status = {'registered':0, 'deposited':0, 'admin_approved':0}
+    # Handle different user states based on status, unknown users start unregistered
+    status = user
     
     # Priority 1: Admin approved users get immediate access
     if status.get('admin_approved', 0) == 1:
@@ -1033,13 +1144,14 @@ async def get_signal(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 [InlineKeyboardButton(lang_data['back_to_main_button'], callback_data="back_to_main")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            message = await context.bot.send_message(
+            message = await safe_telegram_request(
+                context.bot.send_message,
                 chat_id=query.message.chat_id,
                 text=lang_data['admin_approved'],
                 reply_markup=reply_markup
             )
             # Store message ID for potential revocation
-            update_user_last_signal_message(user_id, message.message_id)
+            user['last_signal_message_id'] = message.message_id
             return  # Exit after granting access
     elif status.get('registered', 0) == 0:  # Not registered
         # Unregistered user - send registration message
@@ -1059,21 +1171,23 @@ async def get_signal(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     reply_markup=reply_markup
                 )
         except FileNotFoundError:
-            await context.bot.send_message(
+            await safe_telegram_request(
+                context.bot.send_message,
                 chat_id=query.message.chat_id,
                 text=lang_data['unregistered_caption'],
                 reply_markup=reply_markup
             )
             
         # Create user record if new
-        if not user:
-            create_user(user_id, query.from_user.username)
+        if not user.exists:
+            user['username'] = query.from_user.username
     elif status.get('registered', 0) == 1 and status.get('deposited', 0) == 0:  # Registered but not deposited
         # Send deposit message
         await send_deposit_message(
             chat_id=query.message.chat_id,
             user_id=user_id,
-            context=context
+            context=context,
+            user_lang=user_lang
         )
     else:  # Both registered and deposited OR other cases
         # Show verified access
@@ -1083,13 +1197,14 @@ async def get_signal(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        message = await context.bot.send_message(
+        message = await safe_telegram_request(
+            context.bot.send_message,
             chat_id=query.message.chat_id,
             text=lang_data['verified_access'],
             reply_markup=reply_markup
         )
         # Store message ID for potential revocation
-        update_user_last_signal_message(user_id, message.message_id)
+        user['last_signal_message_id'] = message.message_id
 
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1098,8 +1213,8 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.delete()
     except Exception as e:
         logger.error(f"Error deleting message: {e}")
-    context.user_data['action'] = 'broadcast'
-    await query.message.reply_text("Enter broadcast message:")
+    await_broadcast_message(context)
+    await query.message.reply_text(BROADCAST_PROMPT)
 
 async def user_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1108,8 +1223,8 @@ async def user_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.delete()
     except Exception as e:
         logger.error(f"Error deleting message: {e}")
-    count = get_user_count()
-    await query.message.reply_text(f"🧑‍� Total users: {count}")
+    counters = await run_db(get_user_counters)
+    await query.message.reply_text(f"👥 Total users: {counters['total']} (🚫 {counters['blocked']} unreachable)")
 
 async def upgrade_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -1137,61 +1252,160 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Handle admin commands
     if user_id == ADMIN_ID:
-        if text.isdigit():
+        if context.user_data.get('action') == 'broadcast':
+            # The admin's next message is what gets broadcast
+            await capture_broadcast_message(update, context)
+        elif text.isdigit():
             # Admin is entering a user ID
             target_user_id = int(text)
             # Check which admin action is pending
             if context.user_data.get('action') == 'upgrade':
-                update_user_status(target_user_id, "VIP")
+                await run_db(update_user_status, target_user_id, "VIP")
                 await update.message.reply_text(f"✅ User {target_user_id} upgraded to VIP.")
                 context.user_data.pop('action', None)
             elif context.user_data.get('action') == 'reset':
-                reset_user(target_user_id)
+                await run_db(database.reset_user, target_user_id)
                 await update.message.reply_text(f"✅ User {target_user_id} has been reset.")
                 context.user_data.pop('action', None)
-        elif context.user_data.get('action') == 'broadcast':
-            # Broadcast message to all users
-            users = get_all_users()
-            for user_id in users:
-                try:
-                    await context.bot.send_message(chat_id=user_id, text=text)
-                except Exception as e:
-                    logger.error(f"Failed to send to {user_id}: {e}")
-            await update.message.reply_text(f"📤 Broadcast sent to {len(users)} users.")
-            context.user_data.pop('action', None)
         else:
-            # Check if this is a registration notification
-            if text.startswith('{user_id}'):
-                # Extract user ID from the message
-                try:
-                    user_id_val = int(text.split('}')[1])
-                    # Update user status in JSON for registration
-                    update_user_status_in_json(user_id_val, registered=True)
-                    # Send deposit message to the user
-                    await send_deposit_message(
-                        chat_id=user_id_val,
-                        user_id=user_id_val,
-                        context=context
-                    )
-                    logger.info(f"Automatically sent deposit instructions to user {user_id_val} after registration")
-                except Exception as e:
-                    logger.error(f"Error processing registration notification: {e}")
             # Save action state for admin commands
-            elif text == 'upgrade':
+            if text == 'upgrade':
                 context.user_data['action'] = 'upgrade'
                 await update.message.reply_text("Enter user ID to upgrade to VIP:")
             elif text == 'reset':
                 context.user_data['action'] = 'reset'
                 await update.message.reply_text("Enter user ID to reset:")
             elif text == 'broadcast':
-                context.user_data['action'] = 'broadcast'
-                await update.message.reply_text("Enter broadcast message:")
+                await_broadcast_message(context)
+                await update.message.reply_text(BROADCAST_PROMPT)
     else:
         # Handle regular user messages
         await update.message.reply_text("I don't understand that command. Please use the menu.")
 
+def parse_flag(value):
+    value = value.lower()
+    if value in ('1', 'yes', 'true'):
+        return True
+    if value in ('0', 'no', 'false'):
+        return False
+    raise ValueError(f"expected yes/no, got {value}")
+
+def parse_date(value):
+    return date.fromisoformat(value).isoformat()
+
+# /broadcast segment filter -> (iter_user_ids argument, value parser)
+BROADCAST_FILTERS = {
+    'lang': ('language', str.lower),
+    'language': ('language', str.lower),
+    'registered': ('registered', parse_flag),
+    'deposited': ('deposited', parse_flag),
+    'approved': ('admin_approved', parse_flag),
+    'vip': ('vip', parse_flag),
+    'joined_before': ('joined_before', parse_date),
+    'joined_after': ('joined_after', parse_date),
+}
+
+def parse_start_time(value):
+    """HH:MM (next occurrence) or an ISO datetime, local time unless it has an offset"""
+    if re.fullmatch(r'\d{1,2}:\d{2}', value):
+        hour, minute = map(int, value.split(':'))
+        start = datetime.now().replace(hour=hour, minute=minute, second=0, microsecond=0)
+        return start if start > datetime.now() else start + timedelta(days=1)
+    start = datetime.fromisoformat(value)
+    # Jobs store naive local times
+    return start.astimezone().replace(tzinfo=None) if start.tzinfo else start
+
+def parse_duration(value):
+    """Durations like 90m, 3h or 1h30m, returned in seconds"""
+    match = re.fullmatch(r'(?:(\d+)h)?(?:(\d+)m)?', value)
+    if not match or not value:
+        raise ValueError(f"expected a duration like 90m or 3h, got {value}")
+    return int(match.group(1) or 0) * 3600 + int(match.group(2) or 0) * 60
+
+# Broadcast schedule option -> value parser
+BROADCAST_SCHEDULE = {
+    'at': parse_start_time,
+    'over': parse_duration,
+}
+
+def parse_broadcast_schedule(message):
+    """Split a leading 'at=... over=...' line off a broadcast, returns (start_at, duration, rest)"""
+    first_line, _, rest = message.partition('\n')
+    tokens = first_line.split()
+    if not tokens or not all(token.partition('=')[0] in BROADCAST_SCHEDULE and '=' in token for token in tokens):
+        return None, None, message
+    options = {}
+    for token in tokens:
+        key, _, value = token.partition('=')
+        try:
+            options[key] = BROADCAST_SCHEDULE[key](value)
+        except ValueError as e:
+            raise ValueError(f"bad value for {key}: {e}")
+    return options.get('at'), options.get('over'), rest.strip()
+
+def describe_schedule(start_at, duration):
+    text = ""
+    if start_at:
+        text += f" starting {start_at:%Y-%m-%d %H:%M}"
+    if duration:
+        text += f" spread over {duration // 3600}h {duration % 3600 // 60}m"
+    return text
+
+async def wake_broadcast_runner(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue callback starting a scheduled broadcast on time"""
+    wake_runner()
+
+def schedule_broadcast_start(context: ContextTypes.DEFAULT_TYPE, start_at):
+    """Wake the broadcast runner through the JobQueue when a scheduled job is due.
+
+    Returns False if the job is due now, the runner is then woken once it is stored.
+    """
+    if start_at is None or start_at <= datetime.now():
+        return False
+    context.job_queue.run_once(wake_broadcast_runner, (start_at - datetime.now()).total_seconds())
+    return True
+
+BROADCAST_USAGE = (
+    "Usage: /broadcast Your message here\n\n"
+    "Segments: start a block with filters on its own line, separate blocks with ---\n"
+    "/broadcast lang=hi deposited=no\nHindi text\n---\nlang=en\nEnglish text\n\n"
+    f"Filters: {', '.join(BROADCAST_FILTERS)}\n"
+    f"Placeholders filled per user: {', '.join('{' + name + '}' for name in TEMPLATE_FIELDS)}\n\n"
+    "Schedule with a first line like: at=20:00 over=3h"
+)
+
+def parse_broadcast_segments(message):
+    """Split a /broadcast message into (label, filters, body) segments, raises ValueError on bad filters"""
+    segments = []
+    for block in message.split('\n---\n'):
+        header, _, rest = block.strip().partition('\n')
+        tokens = header.split()
+        filters = {}
+        if tokens and all('=' in token for token in tokens):
+            for token in tokens:
+                key, _, value = token.partition('=')
+                if key not in BROADCAST_FILTERS:
+                    raise ValueError(f"unknown filter {key}")
+                name, parse = BROADCAST_FILTERS[key]
+                try:
+                    filters[name] = parse(value)
+                except ValueError as e:
+                    raise ValueError(f"bad value for {key}: {e}")
+            label, body = header, rest.strip()
+        else:
+            label, body = "all users", block.strip()
+        if not body:
+            raise ValueError(f"segment '{label}' has no message")
+        segments.append((label, filters, body))
+    return segments
+
+async def handle_broadcast_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin media messages (photo, video, document, album...) while a broadcast is awaited"""
+    if context.user_data.get('action') == 'broadcast':
+        await capture_broadcast_message(update, context)
+
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /broadcast command from admin with enhanced features"""
+    """Handle /broadcast command from admin, optionally with one message per user segment"""
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("⚠️ Access denied!")
         return
@@ -1206,231 +1420,260 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = full_text.replace('/broadcast', '', 1).strip()
     
     if not message:
-        await update.message.reply_text("Usage: /broadcast Your message here")
+        await update.message.reply_text(BROADCAST_USAGE)
         return
     
-    logger.info(f"Starting broadcast to all users. Message: {message[:100]}...")
-    
-    # Get user IDs from users.json
-    user_ids = get_all_user_ids()
-    total_users = len(user_ids)
-    
-    if total_users == 0:
-        await update.message.reply_text("⚠️ No users found in the database!")
-        logger.warning("Broadcast attempted with no users in database")
+    try:
+        start_at, duration, message = parse_broadcast_schedule(message)
+        segments = parse_broadcast_segments(message)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}\n\n{BROADCAST_USAGE}")
         return
     
-    logger.info(f"Broadcasting to {total_users} users: {user_ids[:5]}...")
-    
-    success_count = 0
-    failure_count = 0
-    failure_details = []
-    format_failures = {"markdown": 0, "html": 0, "plain": 0}
+    logger.info(f"Queueing broadcast to {len(segments)} segment(s). Message: {message[:100]}...")
     
-    # Send broadcast to all users with format fallback
-    for i, user_id in enumerate(user_ids):
+    # Pick each segment's parse mode once with a preview to the admin instead of retrying per recipient,
+    # the preview is then copied to every recipient of the segment unless it has placeholders
+    sources = []
+    for label, _, body in segments:
         try:
-            # Try sending with Markdown first
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id, 
-                    text=message,
-                    parse_mode="Markdown",
-                    disable_web_page_preview=True
-                )
-                logger.debug(f"Sent Markdown message to {user_id}")
-                success_count += 1
-            except Exception as md_error:
-                format_failures["markdown"] += 1
-                
-                # If Markdown fails, try HTML
-                try:
-                    await context.bot.send_message(
-                        chat_id=user_id, 
-                        text=message,
-                        parse_mode="HTML",
-                        disable_web_page_preview=True
-                    )
-                    logger.debug(f"Sent HTML message to {user_id}")
-                    success_count += 1
-                except Exception as html_error:
-                    format_failures["html"] += 1
-                    
-                    # If both fail, send as plain text
-                    try:
-                        await context.bot.send_message(
-                            chat_id=user_id, 
-                            text=message,
-                            disable_web_page_preview=True
-                        )
-                        logger.debug(f"Sent plain text to {user_id}")
-                        success_count += 1
-                    except Exception as plain_error:
-                        format_failures["plain"] += 1
-                        logger.error(f"Failed all formats for {user_id}: {plain_error}")
-                        failure_details.append(f"{user_id}: {str(plain_error)}")
-                        failure_count += 1
-        except Exception as e:
-            # Handle blocked users silently
-            if "bot was blocked" in str(e).lower():
-                logger.info(f"Silently skipped blocked user: {user_id}")
-                failure_count += 1
-            else:
-                error_msg = f"{user_id}: {str(e)}"
-                logger.warning(f"Failed to send to {error_msg}")
-                failure_details.append(error_msg)
-                failure_count += 1
-        
-        # Add rate limiting
-        await asyncio.sleep(0.05)
+            _, fields = compile_template(body)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {label}: {e}\nWrite literal braces as {{{{ and }}}}.")
+            return
+        try:
+            # Templates are previewed rendered with the admin's own record
+            preview, parse_mode, parse_errors = await choose_parse_mode(
+                partial(safe_telegram_request, context.bot.send_message),
+                update.effective_chat.id, body, context.user_record if fields else None
+            )
+        except BadRequest as e:
+            await update.message.reply_text(f"❌ Telegram rejected the message for {label} even as plain text: {e}")
+            return
+        except TelegramError as e:
+            logger.error(f"Error sending broadcast preview for {label}: {e}")
+            await update.message.reply_text(f"❌ Could not send the preview for {label}, nothing was queued: {e}")
+            return
         
-        # Log progress every 50 users
-        if (i + 1) % 50 == 0:
-            logger.info(f"Broadcast progress: {i+1}/{total_users} users processed")
-    
-    # Create detailed format failure report
-    format_report = (
-        f"📊 Format Failures:\n"
-        f"• Markdown: {format_failures['markdown']}\n"
-        f"• HTML: {format_failures['html']}\n"
-        f"• Plain text: {format_failures['plain']}"
+        format_report = f"📊 {label}: {parse_mode or 'plain text'}"
+        if parse_errors:
+            format_report += "\n" + "\n".join(f"• {mode} rejected: {error}" for mode, error in parse_errors.items())
+        await update.message.reply_text(format_report)
+        if fields:
+            sources.append({'template': body, 'parse_mode': parse_mode})
+        else:
+            sources.append({'from_chat_id': preview.chat_id, 'message_ids': [preview.message_id]})
+    
+    # Scheduled before the job is stored so a failure can't leave a job behind without a reply
+    scheduled = schedule_broadcast_start(context, start_at)
+    # Recipients are selected per segment by indexed queries and stored as a durable job,
+    # the runner sends it in the background and resumes it after a restart
+    job_id, counts = await run_db(
+        create_segmented_broadcast_job, 'copy', {'segments': sources},
+        [filters for _, filters, _ in segments], update.effective_chat.id, start_at, duration
     )
+    total_users = sum(counts)
     
-    # Send concise summary
-    summary = f"✅ Sent to {success_count} users | ❌ Failed: {failure_count}"
-    await update.message.reply_text(summary)
-    
-    # Send format failure details
-    await update.message.reply_text(format_report)
-    
-    # Send detailed failure report if needed
-    if failure_details:
-        failure_report = "📝 Failure Details:\n" + "\n".join(failure_details[:10])
-        if len(failure_details) > 10:
-            failure_report += f"\n...and {len(failure_details)-10} more"
-        await update.message.reply_text(failure_report)
+    if total_users == 0:
+        await run_db(set_broadcast_job_state, job_id, 'cancelled')
+        await update.message.reply_text("⚠️ No users match the broadcast segments!")
+        logger.warning(f"Broadcast #{job_id} matched no users")
+        return
     
-    logger.info(f"Broadcast completed. Success: {success_count}, Failures: {failure_count}")
+    if not scheduled:
+        wake_runner()
+    logger.info(f"Broadcast #{job_id} queued for {total_users} users{describe_schedule(start_at, duration)}: {counts}")
+    segment_report = "\n".join(f"• {label}: {count}" for (label, _, _), count in zip(segments, counts))
+    await update.message.reply_text(
+        f"📤 Broadcast #{job_id} queued for {total_users} users{describe_schedule(start_at, duration)}.\n{segment_report}\n"
+        f"Keep the previews until it finishes, see /broadcasts for progress."
+    )
 
-async def broadcast_photo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /broadcast_photo command - request photo from admin"""
+async def broadcast_message_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /broadcast_message [at=HH:MM] [over=3h] (alias /broadcast_photo) - broadcast the next message the admin sends"""
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("⚠️ Access denied!")
         return
     
-    # Set state to wait for photo
-    context.user_data['awaiting_photo'] = True
-    await update.message.reply_text("🖼️ Please send the photo you want to broadcast with optional caption.")
-
-async def handle_broadcast_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle photo message for broadcasting after /broadcast_photo command"""
-    if not context.user_data.get('awaiting_photo'):
-        return  # Not in photo waiting state
-    
-    # Clear state
-    context.user_data.pop('awaiting_photo', None)
+    try:
+        start_at, duration, rest = parse_broadcast_schedule(' '.join(context.args or []))
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    if rest:
+        await update.message.reply_text("⚠️ Usage: /broadcast_message [at=HH:MM] [over=3h]")
+        return
     
-    # Get photo and caption
-    photo_file = await update.message.photo[-1].get_file()
-    caption = update.message.caption
+    await_broadcast_message(context, start_at, duration)
+    await update.message.reply_text(BROADCAST_PROMPT)
+
+def await_broadcast_message(context, start_at=None, duration=None):
+    """Make the admin's next message the broadcast, replacing the schedule of an earlier attempt"""
+    context.user_data['action'] = 'broadcast'
+    context.user_data['broadcast_schedule'] = (start_at, duration)
+
+async def capture_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Take the admin's message of any type as the broadcast source, albums are collected first"""
+    message = update.effective_message
+    if message.media_group_id:
+        # Album parts arrive as separate updates, confirm once the rest had time to arrive
+        album = context.user_data.get('broadcast_album')
+        if album is None or album['media_group_id'] != message.media_group_id:
+            album = context.user_data['broadcast_album'] = {
+                'media_group_id': message.media_group_id,
+                'message_ids': []
+            }
+            context.job_queue.run_once(
+                finish_broadcast_album, ALBUM_COLLECT_DELAY,
+                chat_id=message.chat_id, user_id=update.effective_user.id
+            )
+        album['message_ids'].append(message.message_id)
+        return
     
-    # Store photo details for confirmation
-    context.user_data['broadcast_photo'] = {
-        'file_id': photo_file.file_id,
-        'caption': caption
-    }
+    context.user_data.pop('action', None)
+    await confirm_broadcast_source(context, message.chat_id, [message.message_id])
+
+async def finish_broadcast_album(context: ContextTypes.DEFAULT_TYPE):
+    """Job run after ALBUM_COLLECT_DELAY to confirm a collected album"""
+    album = context.user_data.pop('broadcast_album', None)
+    context.user_data.pop('action', None)
+    if album:
+        await confirm_broadcast_source(context, context.job.chat_id, sorted(album['message_ids']))
+
+async def confirm_broadcast_source(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_ids: list):
+    """Ask the admin to confirm broadcasting the given messages"""
+    counters = await run_db(get_user_counters)
+    context.user_data['broadcast_source'] = {'from_chat_id': chat_id, 'message_ids': message_ids}
     
-    # Preview photo with confirmation buttons
     keyboard = [
-        [InlineKeyboardButton("✅ Confirm", callback_data="confirm_photo_broadcast")],
-        [InlineKeyboardButton("❌ Cancel", callback_data="cancel_photo_broadcast")]
+        [InlineKeyboardButton("✅ Confirm", callback_data="confirm_broadcast")],
+        [InlineKeyboardButton("❌ Cancel", callback_data="cancel_broadcast")]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    preview_text = "📸 Photo broadcast preview:\n"
-    if caption:
-        preview_text += f"\nCaption: {caption}"
-    
-    try:
-        await context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=photo_file.file_id,
-            caption=preview_text,
-            reply_markup=reply_markup
-        )
-    except Exception as e:
-        logger.error(f"Error sending preview: {e}")
-        await update.message.reply_text("⚠️ Error processing photo. Please try again.")
+    what = f"album of {len(message_ids)}" if len(message_ids) > 1 else "message"
+    await safe_telegram_request(
+        context.bot.send_message,
+        chat_id=chat_id,
+        text=f"📤 Broadcast the {what} above to {counters['total']} users?",
+        reply_to_message_id=message_ids[0],
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-async def execute_photo_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: str, caption: str):
-    """Broadcast photo to all users"""
-    # Get user IDs from users.json
-    user_ids = get_all_user_ids()
-    total_users = len(user_ids)
+async def execute_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, source: dict):
+    """Queue a copy of the source messages to all users"""
+    # Get user IDs from the database
+    user_ids = await run_db(get_all_users)
     
-    if total_users == 0:
-        await context.bot.send_message(
+    if not user_ids:
+        await safe_telegram_request(
+            context.bot.send_message,
             chat_id=update.effective_chat.id,
             text="⚠️ No users found in the database!"
         )
-        logger.warning("Photo broadcast attempted with no users in database")
+        logger.warning("Broadcast attempted with no users in database")
         return
     
-    logger.info(f"Broadcasting photo to {total_users} users")
+    start_at, duration = context.user_data.pop('broadcast_schedule', (None, None))
+    scheduled = schedule_broadcast_start(context, start_at)
+    job_id, total_users = await run_db(
+        create_broadcast_job, 'copy', source, user_ids, update.effective_chat.id,
+        start_at=start_at, duration=duration
+    )
+    if not scheduled:
+        wake_runner()
+    schedule = describe_schedule(start_at, duration)
+    logger.info(f"Broadcast #{job_id} of {len(source['message_ids'])} message(s) queued for {total_users} users{schedule}")
+    await safe_telegram_request(
+        context.bot.send_message,
+        chat_id=update.effective_chat.id,
+        text=f"📤 Broadcast #{job_id} queued for {total_users} users{schedule}. Keep the original message until it finishes."
+    )
+
+async def broadcasts_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command listing recent broadcast jobs and their progress"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("⚠️ Access denied!")
+        return
     
-    success_count = 0
-    failure_count = 0
-    failure_details = []
+    jobs = await run_db(list_broadcast_jobs)
+    if not jobs:
+        await update.message.reply_text("No broadcasts yet.")
+        return
     
-    # Broadcast photo to all users
-    for i, user_id in enumerate(user_ids):
-        try:
-            await context.bot.send_photo(
-                chat_id=user_id,
-                photo=file_id,
-                caption=caption,
-                disable_notification=True
-            )
-            success_count += 1
-        except Exception as e:
-            # Handle blocked users silently
-            if "bot was blocked" in str(e).lower():
-                logger.info(f"Silently skipped blocked user: {user_id}")
-            else:
-                logger.warning(f"Failed to send photo to {user_id}: {e}")
-                failure_details.append(f"{user_id}: {str(e)}")
-            failure_count += 1
-        
-        # Add rate limiting
-        await asyncio.sleep(0.05)
-        
-        # Log progress every 50 users
-        if (i + 1) % 50 == 0:
-            logger.info(f"Photo broadcast progress: {i+1}/{total_users} users processed")
+    lines = ["📤 Recent broadcasts:"]
+    for job in jobs:
+        line = (
+            f"#{job['id']} {job['kind']} {job['state']}: "
+            f"{job['sent'] + job['failed']}/{job['total']} (✅ {job['sent']} | ❌ {job['failed']})"
+        )
+        if job['start_at'] and job['state'] == 'pending':
+            line += f" ⏰ {job['start_at'][:16].replace('T', ' ')}"
+        if job['duration']:
+            line += f" over {int(job['duration']) // 60}m"
+        lines.append(line)
+    await update.message.reply_text("\n".join(lines))
+
+# Admin command -> (new state, states it may move from)
+BROADCAST_CONTROLS = {
+    'broadcast_pause': ('paused', ('pending', 'running')),
+    'broadcast_resume': ('pending', ('paused',)),
+    'broadcast_cancel': ('cancelled', ('pending', 'running', 'paused')),
+}
+
+async def broadcast_control_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin commands to pause, resume or cancel a broadcast job by id"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("⚠️ Access denied!")
+        return
     
-    # Send report to admin
-    summary = f"✅ Photo sent to {success_count} users | ❌ Failed: {failure_count}"
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=summary)
+    command = update.message.text.split()[0].lstrip('/').split('@')[0]
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text(f"⚠️ Usage: /{command} <broadcast_id>")
+        return
     
-    # Send detailed failure report if needed
-    if failure_details:
-        failure_report = "📝 Failure Details:\n" + "\n".join(failure_details[:10])
-        if len(failure_details) > 10:
-            failure_report += f"\n...and {len(failure_details)-10} more"
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=failure_report)
+    job_id = int(context.args[0])
+    state, from_states = BROADCAST_CONTROLS[command]
+    if not await run_db(set_broadcast_job_state, job_id, state, from_states):
+        job = await run_db(get_broadcast_job, job_id)
+        if job is None:
+            await update.message.reply_text(f"❌ Broadcast #{job_id} not found.")
+        else:
+            await update.message.reply_text(f"⚠️ Broadcast #{job_id} is {job['state']}.")
+        return
     
-    logger.info(f"Photo broadcast completed. Success: {success_count}, Failures: {failure_count}")
+    if state == 'pending':
+        wake_runner()
+    else:
+        stop_job(job_id)
+    logger.info(f"Admin set broadcast #{job_id} to {state}")
+    await update.message.reply_text(f"✅ Broadcast #{job_id} {state}.")
 
-async def handle_photo_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle photo broadcast confirmation"""
+async def broadcast_cancel_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel button on a broadcast's live progress message"""
+    query = update.callback_query
+    if update.effective_user.id != ADMIN_ID:
+        await query.answer("⚠️ Access denied!")
+        return
+    
+    job_id = int(query.data.split(':', 1)[1])
+    state, from_states = BROADCAST_CONTROLS['broadcast_cancel']
+    if await run_db(set_broadcast_job_state, job_id, state, from_states):
+        # Workers stop before their next send, the progress message shows the final counts
+        stop_job(job_id)
+        logger.info(f"Admin cancelled broadcast #{job_id} from its progress message")
+        await query.answer(f"🛑 Cancelling broadcast #{job_id}")
+    else:
+        await query.answer(f"Broadcast #{job_id} already finished")
+
+async def handle_broadcast_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle broadcast confirmation"""
     query = update.callback_query
     await query.answer()
     
-    if query.data == "confirm_photo_broadcast":
-        # Get stored photo details
-        photo_data = context.user_data.get('broadcast_photo')
-        if not photo_data:
-            await query.message.reply_text("⚠️ Photo data missing. Please start over.")
+    if query.data == "confirm_broadcast":
+        # Get stored source messages
+        source = context.user_data.get('broadcast_source')
+        if not source:
+            await query.message.reply_text("⚠️ Broadcast message missing. Please start over.")
             return
         
         # Delete confirmation message
@@ -1439,36 +1682,35 @@ async def handle_photo_confirmation(update: Update, context: ContextTypes.DEFAUL
         except Exception as e:
             logger.error(f"Error deleting confirmation message: {e}")
         
-        # Execute broadcast
-        await execute_photo_broadcast(
-            update,
-            context,
-            photo_data['file_id'],
-            photo_data.get('caption', '')
-        )
-    else:  # cancel_photo_broadcast
-        await query.message.reply_text("❌ Photo broadcast cancelled.")
+        await execute_broadcast(update, context, source)
+    else:  # cancel_broadcast
+        await query.message.reply_text("❌ Broadcast cancelled.")
         try:
             await query.message.delete()
         except Exception as e:
             logger.error(f"Error deleting message: {e}")
     
     # Clear stored data
-    context.user_data.pop('broadcast_photo', None)
+    context.user_data.pop('broadcast_source', None)
+    context.user_data.pop('broadcast_schedule', None)
+
 async def approve_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin command to manually approve a user for signal access"""
+    """Admin command to manually approve one or more users for signal access"""
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("🚫 You are not authorized to use this command.")
         return
 
-    if len(context.args) != 1 or not context.args[0].isdigit():
-        await update.message.reply_text("⚠️ Usage: /approve_user <user_id>")
+    if not context.args or not all(arg.isdigit() for arg in context.args):
+        await update.message.reply_text("⚠️ Usage: /approve_user <user_id> [user_id ...]")
         return
 
-    user_id = int(context.args[0])
-    update_user_admin_approved(user_id, True)  # Use helper function
+    user_ids = [int(arg) for arg in context.args]
+    await run_db(bulk_approve, user_ids)
 
-    await update.message.reply_text(f"✅ User {user_id} manually approved for Get Signal access.")
+    if len(user_ids) == 1:
+        await update.message.reply_text(f"✅ User {user_ids[0]} manually approved for Get Signal access.")
+    else:
+        await update.message.reply_text(f"✅ {len(user_ids)} users manually approved for Get Signal access.")
 
 async def revoke_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to revoke a user's admin approval for signal access"""
@@ -1481,37 +1723,22 @@ async def revoke_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     user_id = int(context.args[0])
-    filename = "users.json"
     
     try:
-        if not os.path.exists(filename):
-            await update.message.reply_text("❌ User database not found.")
-            return
-
-        with open(filename, 'r') as f:
-            users = json.load(f)
-            
-        user_found = False
-        message_id = 0
-        for user in users:
-            if user['id'] == user_id:
-                # Get last signal message ID before revoking
-                message_id = user.get('last_signal_message_id', 0)
-                user['admin_approved'] = 0
-                user_found = True
-                break
-                
-        if not user_found:
+        user = await run_db(get_user_record, user_id)
+        if user is None:
             await update.message.reply_text(f"⚠️ User {user_id} not found.")
             return
             
-        with open(filename, 'w') as f:
-            json.dump(users, f, indent=2)
+        # Get last signal message ID before revoking
+        message_id = user['last_signal_message_id']
+        await run_db(update_user_fields, user_id, admin_approved=0)
             
         # Delete last signal message if exists
         if message_id:
             try:
-                await context.bot.delete_message(
+                await safe_telegram_request(
+                    context.bot.delete_message,
                     chat_id=user_id,
                     message_id=message_id
                 )
@@ -1520,7 +1747,8 @@ async def revoke_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         
         # Send revocation notice to user
         try:
-            await context.bot.send_message(
+            await safe_telegram_request(
+                context.bot.send_message,
                 chat_id=user_id,
                 text="⚠️ Your signal access has been revoked by the admin."
             )
@@ -1534,14 +1762,13 @@ async def revoke_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 # New command to get user count
 async def get_user_count(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Return total number of users from users.json"""
+    """Return total number of users from the database"""
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("⚠️ Access denied!")
         return
         
-    user_ids = get_all_user_ids()
-    count = len(user_ids)
-    await update.message.reply_text(f"👥 Total users: {count}")
+    counters = await run_db(get_user_counters)
+    await update.effective_message.reply_text(f"👥 Total users: {counters['total']} (🚫 {counters['blocked']} unreachable)")
 
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1557,7 +1784,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     try:
         user_id = int(context.args[0])
-        status = check_user_status(user_id)
+        status = await run_db(get_user_record, user_id)
         
         if status is None:
             await update.message.reply_text(f"❌ User {user_id} not found in database")
@@ -1586,26 +1813,23 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     # If no arguments, show aggregate counts
     if not context.args:
-        user_ids = get_all_user_ids()
-        total_users = len(user_ids)
-        
-        # Count registered and deposited users
-        registered_count = 0
-        deposited_count = 0
-        for user_id in user_ids:
-            status = check_user_status(user_id)
-            if status:
-                if status.get('registered', 0) == 1:
-                    registered_count += 1
-                if status.get('deposited', 0) == 1:
-                    deposited_count += 1
+        # Counters are maintained by the database on every state change
+        counters = await run_db(get_user_counters)
+        tombstones = await run_db(get_tombstone_counts)
         
         response = (
             f"📊 Bot User Statistics:\n\n"
-            f"👥 Total Users: {total_users}\n"
-            f"📝 Registered Users: {registered_count}\n"
-            f"💰 Deposited Users: {deposited_count}"
+            f"👥 Total Users: {counters['total']}\n"
+            f"📝 Registered Users: {counters['registered']}\n"
+            f"💰 Deposited Users: {counters['deposited']}\n"
+            f"💎 VIP Users: {counters['vip']}\n"
+            f"👑 Admin Approved: {counters['approved']}\n"
+            f"🚫 Unreachable (not counted above): {counters['blocked']}\n"
+            f"🔁 Telegram retries: {retry_stats['retries']} ({retry_stats['backoff_seconds']:.0f}s backing off, "
+            f"{retry_stats['gave_up'] + retry_stats['budget_exhausted']} gave up)"
         )
+        if tombstones:
+            response += "\n" + "\n".join(f"• {reason}: {count}" for reason, count in tombstones.items())
         await update.message.reply_text(response)
         return
         
@@ -1615,7 +1839,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     user_id = int(context.args[0])
-    status = check_user_status(user_id)
+    status = await run_db(get_user_record, user_id)
     
     if status is None:
         await update.message.reply_text(f"❌ User {user_id} not found")
@@ -1628,56 +1852,45 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"💰 Deposited: {'✅' if status['deposited'] else '❌'}\n"
         f"👑 Admin Approved: {'✅' if status['admin_approved'] else '❌'}"
     )
+    if status['blocked']:
+        response += f"\n🚫 Unreachable: {status['blocked_reason']} since {status['blocked_at']}"
     
     await update.message.reply_text(response)
 
 async def total_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Return total number of users from users.json"""
+    """Return total number of users from the database"""
     if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("⚠️ Access denied!")
+        await update.effective_message.reply_text("⚠️ Access denied!")
         return
         
-    user_ids = get_all_user_ids()
-    count = len(user_ids)
-    await update.message.reply_text(f"👥 Total users: {count}")
+    counters = await run_db(get_user_counters)
+    await update.effective_message.reply_text(f"👥 Total users: {counters['total']} (🚫 {counters['blocked']} unreachable)")
 
 async def total_registered_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Return total number of registered users from users.json"""
+    """Return total number of registered users from the database"""
     if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("⚠️ Access denied!")
+        await update.effective_message.reply_text("⚠️ Access denied!")
         return
         
-    filename = "users.json"
     try:
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                users = json.load(f)
-                count = sum(1 for u in users if u.get('registered', 0) == 1)
-            await update.message.reply_text(f"📝 Total registered users: {count}")
-        else:
-            await update.message.reply_text("❌ users.json file not found")
+        counters = await run_db(get_user_counters)
+        await update.effective_message.reply_text(f"📝 Total registered users: {counters['registered']}")
     except Exception as e:
-        logger.error(f"Error reading users.json: {e}")
-        await update.message.reply_text("⚠️ Error retrieving registered users count")
+        logger.error(f"Error reading users from database: {e}")
+        await update.effective_message.reply_text("⚠️ Error retrieving registered users count")
 
 async def total_deposited_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Return total number of users who made a deposit from users.json"""
+    """Return total number of users who made a deposit from the database"""
     if update.effective_user.id != ADMIN_ID:
-        await update.message.reply_text("⚠️ Access denied!")
+        await update.effective_message.reply_text("⚠️ Access denied!")
         return
         
-    filename = "users.json"
     try:
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                users = json.load(f)
-                count = sum(1 for u in users if u.get('deposited', 0) == 1)
-            await update.message.reply_text(f"💰 Total deposited users: {count}")
-        else:
-            await update.message.reply_text("❌ users.json file not found")
+        counters = await run_db(get_user_counters)
+        await update.effective_message.reply_text(f"💰 Total deposited users: {counters['deposited']}")
     except Exception as e:
-        logger.error(f"Error reading users.json: {e}")
-        await update.message.reply_text("⚠️ Error retrieving deposited users count")
+        logger.error(f"Error reading users from database: {e}")
+        await update.effective_message.reply_text("⚠️ Error retrieving deposited users count")
 
 async def export_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Export user data to a CSV file"""
@@ -1685,26 +1898,22 @@ async def export_users_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("⚠️ Access denied!")
         return
         
-    filename = "users.json"
     try:
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                users = json.load(f)
-                
-            # Create CSV content
-            csv_content = "User ID,Username,Registered,Deposited\n"
-            for user in users:
-                csv_content += f"{user['id']},{user.get('username', '')},{user.get('registered', 0)},{user.get('deposited', 0)}\n"
-                
-            # Send CSV as document
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=io.BytesIO(csv_content.encode()),
-                filename="users_export.csv",
-                caption="📁 User data export"
-            )
-        else:
-            await update.message.reply_text("❌ users.json file not found")
+        users = await run_db(get_all_user_records)
+            
+        # Create CSV content
+        csv_content = "User ID,Username,Registered,Deposited\n"
+        for user in users:
+            csv_content += f"{user['id']},{user['username'] or ''},{user['registered']},{user['deposited']}\n"
+            
+        # Send CSV as document
+        await safe_telegram_request(
+            context.bot.send_document,
+            chat_id=update.effective_chat.id,
+            document=io.BytesIO(csv_content.encode()),
+            filename="users_export.csv",
+            caption="📁 User data export"
+        )
     except Exception as e:
         logger.error(f"Error exporting users: {e}")
         await update.message.reply_text("⚠️ Error exporting user data")
@@ -1715,8 +1924,11 @@ async def refresh_data_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("⚠️ Access denied!")
         return
         
-    # This would typically reload data from the database
-    await update.message.reply_text("♻️ User data refreshed successfully")
+    synced = await run_db(sync_databases)
+    if synced is None:
+        await update.message.reply_text("⚠️ Error refreshing user data")
+        return
+    await update.message.reply_text(f"♻️ User data refreshed successfully ({synced} changed users synced)")
 
 async def check_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /check_user command to get detailed user status"""
@@ -1730,7 +1942,7 @@ async def check_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
         
     user_id = int(context.args[0])
-    status = check_user_status(user_id)
+    status = await run_db(get_user_record, user_id)
     
     if status is None:
         await update.message.reply_text(f"❌ User {user_id} not found")
@@ -1743,6 +1955,8 @@ async def check_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         f"💰 Deposited: {'✅' if status['deposited'] else '❌'}\n"
         f"👑 Admin Approved: {'✅' if status['admin_approved'] else '❌'}"
     )
+    if status['blocked']:
+        response += f"\n🚫 Unreachable: {status['blocked_reason']} since {status['blocked_at']}"
     
     await update.message.reply_text(response)
 
@@ -1768,14 +1982,14 @@ async def admin_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer()
     
     if query.data == "admin_total_users":
-        await total_users_command(query.message, context)
+        await total_users_command(update, context)
     elif query.data == "admin_total_registered":
-        await total_registered_command(query.message, context)
+        await total_registered_command(update, context)
     elif query.data == "admin_total_deposited":
-        await total_deposited_command(query.message, context)
+        await total_deposited_command(update, context)
     elif query.data == "admin_broadcast":
-        context.user_data['action'] = 'broadcast'
-        await query.message.reply_text("Enter broadcast message:")
+        await_broadcast_message(context)
+        await query.message.reply_text(BROADCAST_PROMPT)
     elif query.data == "admin_export_users":
         await export_users_command(query.message, context)
     elif query.data == "admin_refresh_data":
@@ -1832,6 +2046,32 @@ def create_system_mutex():
 
 import time
 
+async def post_init(application: Application):
+    """Open the shared HTTP client, start the broadcast job runner and the postback endpoint.
+
+    The runner resumes jobs interrupted by the last shutdown.
+    """
+    http_client.open_session()
+    start_runner(application.bot)
+    start_postback_workers(application)
+    await start_postback_server(apply_postbacks)
+
+async def post_stop(application: Application):
+    """Stop the broadcast job runner and the postback endpoint while the bot can still send"""
+    # Application.shutdown closes the bot's HTTP client, in-flight sends must finish before it.
+    # Queued postbacks are recorded and their follow-up messages sent
+    await stop_postback_server()
+    await stop_postback_workers()
+    # Running broadcasts checkpoint their cursor and resume on the next start
+    await stop_runner()
+
+async def post_shutdown(application: Application):
+    """Flush the users.json mirror and close database connections before the process exits"""
+    await http_client.close_session()
+    await run_db(sync_databases)
+    user_store.close()
+    shutdown_db()
+
 def main():
     # Create system mutex to prevent multiple instances
     mutex = create_system_mutex()
@@ -1846,9 +2086,39 @@ def main():
     
     # Initialize database
     init_db()
+    # Users only stored in users.json by older versions are imported before the first sync
+    import_users_json()
     
     # Create Application with concurrency control
-    application = Application.builder().token(BOT_TOKEN).concurrent_updates(False).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(False)
+        # One shared send budget, user replies are served ahead of admin reports and broadcasts
+        .rate_limiter(OutboxRateLimiter(ADMIN_ID))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    
+    # Incremental users.json mirror, cost scales with the number of changed users
+    application.job_queue.run_repeating(
+        sync_databases_job,
+        interval=USERS_JSON_SYNC_INTERVAL,
+        first=USERS_JSON_SYNC_INTERVAL
+    )
+    
+    # Users who never press a check button are verified and moved on in the background
+    application.job_queue.run_repeating(
+        verify_pending_users_job,
+        interval=VERIFY_POLL_INTERVAL,
+        first=VERIFY_POLL_INTERVAL
+    )
+    
+    # Load the user's record before and save it after every handler
+    application.add_handler(TypeHandler(Update, load_user_context), group=-1)
+    application.add_handler(TypeHandler(Update, save_user_context), group=1)
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -1858,7 +2128,10 @@ def main():
     application.add_handler(CommandHandler("total_registered", total_registered_command))
     application.add_handler(CommandHandler("total_deposited", total_deposited_command))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
-    application.add_handler(CommandHandler("broadcast_photo", broadcast_photo_command))
+    application.add_handler(CommandHandler(["broadcast_message", "broadcast_photo"], broadcast_message_command))
+    application.add_handler(CommandHandler("broadcasts", broadcasts_command))
+    for command in BROADCAST_CONTROLS:
+        application.add_handler(CommandHandler(command, broadcast_control_command))
     application.add_handler(CommandHandler("status", status_command))
     application.add_handler(CommandHandler("export_users", export_users_command))
     application.add_handler(CommandHandler("refresh_data", refresh_data_command))
@@ -1866,6 +2139,7 @@ def main():
     application.add_handler(CommandHandler("approve_user", approve_user))
     application.add_handler(CommandHandler("revoke_user", revoke_user_command))
     application.add_handler(CallbackQueryHandler(admin_button_handler, pattern="^admin_"))
+    application.add_handler(CallbackQueryHandler(broadcast_cancel_button, pattern="^broadcast_cancel:"))
     application.add_handler(CallbackQueryHandler(register, pattern="^register$"))
     application.add_handler(CallbackQueryHandler(check_deposit, pattern="^check_deposit$"))
     application.add_handler(CallbackQueryHandler(instruction, pattern="^instruction$"))
@@ -1880,9 +2154,9 @@ def main():
     application.add_handler(CallbackQueryHandler(reset_user, pattern="^reset_user$"))
     application.add_handler(CallbackQueryHandler(back_to_main, pattern="^back_to_main$"))
     application.add_handler(CallbackQueryHandler(check_registration_callback, pattern="^check_registration$"))
-    application.add_handler(CallbackQueryHandler(handle_photo_confirmation, pattern="^(confirm_photo_broadcast|cancel_photo_broadcast)$"))
+    application.add_handler(CallbackQueryHandler(handle_broadcast_confirmation, pattern="^(confirm_broadcast|cancel_broadcast)$"))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(MessageHandler(filters.PHOTO & filters.Chat(chat_id=ADMIN_ID), handle_broadcast_photo))
+    application.add_handler(MessageHandler(~filters.TEXT & ~filters.COMMAND & filters.Chat(chat_id=ADMIN_ID), handle_broadcast_media))
     
     # Start bot with enhanced error handling
     try:
@@ -0,0 +1,589 @@
+import os
+import html
+import time
+import string
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, Forbidden, BadRequest
+from telegram.helpers import escape_markdown
+
+import database
+from database import run_db
+from outbox import outbox, PREACQUIRED
+
+# Minimum seconds between two broadcast messages to the same chat
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1"))
+# Concurrent send workers per broadcast
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+# Recipients sent between two cursor checkpoints, at most this many can be resent after a crash
+JOB_BATCH_SIZE = 50
+# Seconds the job runner sleeps when no job is waiting
+JOB_POLL_INTERVAL = 5
+# Consecutive failed runs after which a job is paused for the admin
+JOB_MAX_FAILURES = 3
+# Days the recipient rows of a finished job are kept when they were not dropped after its report
+JOB_RECIPIENT_RETENTION_DAYS = int(os.getenv("BROADCAST_RECIPIENT_RETENTION_DAYS", "7"))
+# Seconds between two sweeps for expired recipient rows
+JOB_PRUNE_INTERVAL = 3600
+# Log job progress every this many batches
+PROGRESS_LOG_EVERY = 10
+# Highest msg/s a drip (duration) broadcast may use, the rest of OUTBOX_RATE stays free for interactive traffic
+DRIP_MAX_RATE = float(os.getenv("BROADCAST_DRIP_MAX_RATE", "15"))
+# Lowest msg/s of a drip broadcast, so small audiences don't sleep for hours between sends
+DRIP_MIN_RATE = 0.01
+# Minimum seconds between two edits of the admin's live progress message
+PROGRESS_EDIT_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_EDIT_INTERVAL", "3"))
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Shared send budget: refills at `rate` tokens/sec up to `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Wait until a token is available and take it, waiters are served in order"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds`, e.g. after a RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+class PerChatLimiter:
+    """Spaces out consecutive sends to the same chat by `interval` seconds"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next_allowed = {}
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        next_allowed = self._next_allowed.get(chat_id, 0.0)
+        if next_allowed > now:
+            await asyncio.sleep(next_allowed - now)
+            now = next_allowed
+        self._next_allowed[chat_id] = now + self.interval
+        # Forget chats whose slot has long passed so the map stays small
+        if len(self._next_allowed) > 10000:
+            self._next_allowed = {cid: t for cid, t in self._next_allowed.items() if t > now}
+
+per_chat = PerChatLimiter(BROADCAST_PER_CHAT_INTERVAL)
+
+def tombstone_reason(error):
+    """Return why a send error means the chat is permanently unreachable, or None"""
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        return 'deactivated' if 'deactivated' in message else 'blocked'
+    if isinstance(error, BadRequest) and 'chat not found' in message:
+        return 'chat_not_found'
+    return None
+
+class DripPacer:
+    """Spreads a job's sends evenly until its deadline, adapting after each batch.
+
+    The pace is recomputed from the remaining recipients and time left, so a job
+    that fell behind speeds up, but never above a ceiling that is halved on
+    every RetryAfter and recovers slowly after clean batches.
+    """
+
+    def __init__(self, job):
+        start = datetime.fromisoformat(job['start_at'] or job['created_at'])
+        if start.tzinfo:
+            start = start.astimezone().replace(tzinfo=None)
+        self.deadline = start + timedelta(seconds=job['duration'])
+        self.ceiling = DRIP_MAX_RATE
+        self.bucket = TokenBucket(DRIP_MIN_RATE, capacity=1)
+
+    def adjust(self, remaining, rate_limited=False):
+        if rate_limited:
+            self.ceiling = max(DRIP_MIN_RATE, self.ceiling / 2)
+            logger.info(f"Drip broadcast rate limited, ceiling lowered to {self.ceiling:.2f} msg/s")
+        else:
+            self.ceiling = min(DRIP_MAX_RATE, self.ceiling * 1.1)
+        seconds_left = (self.deadline - datetime.now()).total_seconds()
+        target = remaining / seconds_left if seconds_left > 0 else self.ceiling
+        self.bucket.rate = min(self.ceiling, max(DRIP_MIN_RATE, target))
+
+async def acquire_or_stop(stop, limiter=None):
+    """Take a send slot (the outbox bulk lane by default), returns False instead
+    if `stop` is set while waiting (e.g. during a RetryAfter pause)"""
+    slot = limiter.acquire() if limiter else outbox.acquire('bulk')
+    if stop is None:
+        await slot
+        return True
+    acquire = asyncio.ensure_future(slot)
+    stopped = asyncio.ensure_future(stop.wait())
+    done, _ = await asyncio.wait({acquire, stopped}, return_when=asyncio.FIRST_COMPLETED)
+    if acquire in done:
+        stopped.cancel()
+        return True
+    acquire.cancel()
+    return False
+
+async def run_broadcast(chat_ids, send, workers=BROADCAST_WORKERS, label="Broadcast", stop=None, pace=None):
+    """Send to every chat with concurrent workers in the outbox bulk lane.
+
+    `send(chat_id)` performs one API call whose slot was already taken, see
+    PREACQUIRED. RetryAfter pauses the outbox for all lanes and the chat is
+    retried; other errors are recorded. Setting the
+    `stop` event makes workers finish their current send and take no new chats.
+    An optional `pace` TokenBucket further limits this broadcast alone.
+    Returns a dict with sent/failed/blocked counts, a list of (chat_id, error)
+    failures, (chat_id, reason) tombstones for permanently unreachable chats and
+    (chat_id, outcome, error) outcomes for every chat attempted.
+    """
+    chat_ids = list(chat_ids)
+    pending = iter(chat_ids)
+    result = {'sent': 0, 'failed': 0, 'blocked': 0, 'rate_limited': 0, 'failures': [], 'tombstones': [], 'outcomes': []}
+
+    async def worker():
+        for chat_id in pending:
+            while True:
+                if stop is not None and stop.is_set():
+                    return
+                await per_chat.wait(chat_id)
+                if pace is not None and not await acquire_or_stop(stop, pace):
+                    return
+                if not await acquire_or_stop(stop):
+                    return
+                try:
+                    await send(chat_id)
+                    result['sent'] += 1
+                    result['outcomes'].append((chat_id, 'sent', None))
+                except RetryAfter as e:
+                    logger.warning(f"{label} rate limited, pausing all sends for {e.retry_after}s")
+                    outbox.pause(e.retry_after)
+                    result['rate_limited'] += 1
+                    continue
+                except Exception as e:
+                    reason = tombstone_reason(e)
+                    if reason:
+                        # Bot was blocked, the account is gone or the chat never existed
+                        logger.info(f"{label}: user {chat_id} unreachable ({reason}): {e}")
+                        result['blocked'] += 1
+                        result['failed'] += 1
+                        result['tombstones'].append((chat_id, reason))
+                        result['outcomes'].append((chat_id, 'blocked', str(e)))
+                        break
+                    logger.warning(f"{label}: failed to send to {chat_id}: {e}")
+                    result['failures'].append((chat_id, str(e)))
+                    result['failed'] += 1
+                    result['outcomes'].append((chat_id, 'failed', str(e)))
+                break
+
+    await asyncio.gather(*(worker() for _ in range(min(workers, len(chat_ids)))))
+    return result
+
+# Durable broadcast jobs
+
+# Broadcast sends take their outbox slot in run_broadcast, the bot's rate limiter must not wait again
+SEND_SLOT_TAKEN = {'lane': PREACQUIRED}
+# Parse modes tried in order when validating a text broadcast
+PARSE_MODES = ["Markdown", "HTML", None]
+# Affiliate registration link of a user, as in the deposit and registration messages
+REGISTER_LINK = "https://1wzyuh.com/casino/list?open=register&p=h53j&sub1={user_id}"
+# Broadcast template placeholders -> value taken from the recipient's user record
+TEMPLATE_FIELDS = {
+    'user_id': lambda user: user['id'],
+    'username': lambda user: user.get('username') or '',
+    'language': lambda user: user.get('language') or 'en',
+    'register_link': lambda user: REGISTER_LINK.format(user_id=user['id']),
+}
+# Escaping of placeholder values so they can't break the message's formatting
+TEMPLATE_ESCAPES = {
+    'Markdown': escape_markdown,
+    'HTML': html.escape,
+    None: str,
+}
+
+_wakeup = None
+_runner_task = None
+_shutting_down = False
+# job id -> stop event of each job currently being sent
+_running = {}
+# job id -> consecutive failed runs
+_failures = {}
+
+def compile_template(text, parse_mode=None):
+    """Compile broadcast text with {placeholders} once into a render(user) function.
+
+    Returns (render, fields). Values are escaped for parse_mode. Raises
+    ValueError on unknown placeholders or unbalanced braces, literal braces
+    are written {{ and }}.
+    """
+    escape = TEMPLATE_ESCAPES[parse_mode]
+    pattern, getters = [], []
+    for literal, field, spec, conversion in string.Formatter().parse(text):
+        pattern.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is None:
+            continue
+        if field not in TEMPLATE_FIELDS:
+            raise ValueError(f"unknown placeholder {{{field}}}, available: {', '.join(TEMPLATE_FIELDS)}")
+        if spec or conversion:
+            raise ValueError(f"placeholder {{{field}}} takes no format spec")
+        pattern.append('{}')
+        getters.append(TEMPLATE_FIELDS[field])
+    pattern = ''.join(pattern)
+    fields = tuple(getters)
+
+    def render(user):
+        return pattern.format(*(escape(str(getter(user))) for getter in fields))
+    return render, fields
+
+async def choose_parse_mode(send_message, chat_id, text, user=None):
+    """Find the first parse mode Telegram accepts for `text` with one test send to `chat_id`.
+
+    send_message takes the keyword arguments of Bot.send_message. text is a
+    template, the test send is rendered for the `user` record. Returns
+    (message, parse_mode, errors) where message is the accepted test send and
+    errors maps each rejected mode to its parse error. Raises BadRequest if
+    even plain text is rejected.
+    """
+    errors = {}
+    for parse_mode in PARSE_MODES:
+        try:
+            message = await send_message(
+                chat_id=chat_id,
+                text=compile_template(text, parse_mode)[0](user or {}),
+                parse_mode=parse_mode,
+                disable_web_page_preview=True
+            )
+            return message, parse_mode, errors
+        except BadRequest as e:
+            errors[parse_mode or 'plain'] = str(e)
+            if parse_mode is None:
+                raise
+
+def job_sources(job):
+    """Return the per-segment sources of a job, segmented jobs carry one per segment"""
+    return job['payload'].get('segments') or [job['payload']]
+
+def make_sender(bot, job):
+    """Build the send(chat_id, segment, user) callable for a job.
+
+    Sources are copied by reference; template sources are compiled here once
+    and rendered per recipient from the preloaded user record.
+    """
+    sources = job_sources(job)
+    renderers = {
+        segment: compile_template(source['template'], source.get('parse_mode'))[0]
+        for segment, source in enumerate(sources) if 'template' in source
+    }
+
+    def send(chat_id, segment, user=None):
+        source = sources[segment]
+        if segment in renderers:
+            return bot.send_message(
+                chat_id=chat_id,
+                text=renderers[segment](user or {'id': chat_id}),
+                parse_mode=source.get('parse_mode'),
+                disable_web_page_preview=True,
+                rate_limit_args=SEND_SLOT_TAKEN
+            )
+        if len(source['message_ids']) == 1:
+            return bot.copy_message(
+                chat_id=chat_id,
+                from_chat_id=source['from_chat_id'],
+                message_id=source['message_ids'][0],
+                rate_limit_args=SEND_SLOT_TAKEN
+            )
+        # Albums go out as one album
+        return bot.copy_messages(
+            chat_id=chat_id,
+            from_chat_id=source['from_chat_id'],
+            message_ids=source['message_ids'],
+            rate_limit_args=SEND_SLOT_TAKEN
+        )
+    return send
+
+def wake_runner():
+    """Tell the job runner a job was queued or resumed"""
+    if _wakeup is not None:
+        _wakeup.set()
+
+def stop_job(job_id):
+    """Stop sending a running job after the in-flight messages, its state decides what happens next"""
+    stop = _running.get(job_id)
+    if stop is not None:
+        stop.set()
+
+class ProgressMessage:
+    """Status message in the admin chat, edited in place at most every PROGRESS_EDIT_INTERVAL seconds"""
+
+    def __init__(self, bot, job):
+        self.bot = bot
+        self.job_id = job['id']
+        self.chat_id = job['report_chat_id']
+        self.total = job['total']
+        self.message_id = None
+        self.started = time.monotonic()
+        self.start_done = job['sent'] + job['failed']
+        self.last_edit = 0.0
+
+    def _text(self, sent, failed, state):
+        done = sent + failed
+        remaining = self.total - done
+        elapsed = time.monotonic() - self.started
+        rate = (done - self.start_done) / elapsed if elapsed > 0 else 0.0
+        eta = f"{int(remaining / rate) // 60}m {int(remaining / rate) % 60}s" if rate > 0 else "-"
+        return (
+            f"📤 Broadcast #{self.job_id}: {state}\n"
+            f"✅ Sent: {sent} | ❌ Failed: {failed} | ⏳ Remaining: {remaining}\n"
+            f"⚡ {rate:.1f} msg/s | ETA: {eta}"
+        )
+
+    def _markup(self):
+        return InlineKeyboardMarkup(
+            [[InlineKeyboardButton("🛑 Cancel", callback_data=f"broadcast_cancel:{self.job_id}")]]
+        )
+
+    async def start(self, sent, failed):
+        if not self.chat_id:
+            return
+        try:
+            message = await self.bot.send_message(
+                chat_id=self.chat_id, text=self._text(sent, failed, 'running'), reply_markup=self._markup()
+            )
+            self.message_id = message.message_id
+            self.last_edit = time.monotonic()
+        except Exception as e:
+            logger.warning(f"Broadcast #{self.job_id}: could not post progress message: {e}")
+
+    async def update(self, sent, failed, state='running', final=False):
+        """Edit the status message, skipped if the last edit was too recent unless final"""
+        if self.message_id is None:
+            return
+        if not final and time.monotonic() - self.last_edit < PROGRESS_EDIT_INTERVAL:
+            return
+        self.last_edit = time.monotonic()
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                text=self._text(sent, failed, state),
+                reply_markup=None if final else self._markup()
+            )
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                logger.warning(f"Broadcast #{self.job_id}: could not edit progress message: {e}")
+        except Exception as e:
+            logger.warning(f"Broadcast #{self.job_id}: could not edit progress message: {e}")
+
+async def send_job_report(bot, job):
+    """Send the final summary of a job to the chat that created it"""
+    if not job['report_chat_id']:
+        return
+    if job['state'] == 'cancelled':
+        summary = f"🛑 Broadcast #{job['id']} cancelled: ✅ Sent to {job['sent']} users | ❌ Failed: {job['failed']}"
+    else:
+        summary = f"✅ Broadcast #{job['id']}: Sent to {job['sent']} users | ❌ Failed: {job['failed']}"
+    blocked = (await run_db(database.count_broadcast_outcomes, job['id'])).get('blocked', 0)
+    if blocked:
+        summary += f"\n🚫 {blocked} unreachable users tombstoned, future broadcasts skip them"
+    await bot.send_message(chat_id=job['report_chat_id'], text=summary)
+
+    failures = await run_db(database.get_broadcast_failures, job['id'], 11)
+    if failures:
+        failure_report = "📝 Failure Details:\n" + "\n".join(f"{user_id}: {error}" for user_id, error in failures[:10])
+        if len(failures) > 10:
+            failure_report += "\n...and more"
+        await bot.send_message(chat_id=job['report_chat_id'], text=failure_report)
+
+async def run_job(bot, job):
+    """Send a job's remaining recipients batch by batch, checkpointing the cursor after each batch"""
+    job_id = job['id']
+    if not await run_db(database.set_broadcast_job_state, job_id, 'running', ('pending', 'running')):
+        return
+    label = f"Broadcast #{job_id}"
+    logger.info(f"{label} starting at cursor {job['cursor']} ({job['sent'] + job['failed']}/{job['total']} done)")
+    send = make_sender(bot, job)
+    templated = any('template' in source for source in job_sources(job))
+    stop = asyncio.Event()
+    _running[job_id] = stop
+    cursor = job['cursor']
+    sent, failed = job['sent'], job['failed']
+    progress = ProgressMessage(bot, job)
+    pacer = None
+    batches = 0
+    try:
+        await progress.start(sent, failed)
+        if job['duration']:
+            pacer = DripPacer(job)
+            pacer.adjust(job['total'] - sent - failed)
+            logger.info(f"{label} dripping until {pacer.deadline:%Y-%m-%d %H:%M} at {pacer.bucket.rate:.2f} msg/s")
+        while not stop.is_set():
+            batch = await run_db(database.get_pending_recipients, job_id, cursor, JOB_BATCH_SIZE)
+            if not batch:
+                break
+            seq_of = {user_id: seq for seq, user_id, _ in batch}
+            segment_of = {user_id: segment for _, user_id, segment in batch}
+            # Template fields for the whole batch come from one query, not one per recipient
+            users = {}
+            if templated:
+                users = {user['id']: user for user in await run_db(database.get_user_records, list(seq_of))}
+            result = await run_broadcast(
+                list(seq_of), lambda chat_id: send(chat_id, segment_of[chat_id], users.get(chat_id)),
+                label=label, stop=stop, pace=pacer.bucket if pacer else None
+            )
+            outcomes = [(seq_of[chat_id], outcome, error) for chat_id, outcome, error in result['outcomes']]
+            done = {seq for seq, _, _ in outcomes}
+            unsent = [seq for seq, _, _ in batch if seq not in done]
+            # Never move the cursor past a recipient that was not attempted
+            cursor = min(unsent) - 1 if unsent else batch[-1][0]
+            await run_db(database.record_broadcast_outcomes, job_id, outcomes, cursor)
+            if result['tombstones']:
+                await run_db(database.record_tombstones, result['tombstones'])
+            sent += result['sent']
+            failed += result['failed']
+            await progress.update(sent, failed)
+            if pacer:
+                pacer.adjust(job['total'] - sent - failed, result['rate_limited'] > 0)
+            batches += 1
+            if batches % PROGRESS_LOG_EVERY == 0:
+                logger.info(f"{label} progress: {sent + failed}/{job['total']} users processed")
+    finally:
+        _running.pop(job_id, None)
+
+    if _shutting_down:
+        # Left in 'running' so it resumes from the cursor on the next start
+        logger.info(f"{label} interrupted by shutdown at cursor {cursor}")
+        await progress.update(sent, failed, 'interrupted by restart, resuming on start', final=True)
+        return
+    # Finished unless an admin paused or cancelled it meanwhile
+    await run_db(database.set_broadcast_job_state, job_id, 'done', ('running',))
+    job = await run_db(database.get_broadcast_job, job_id)
+    logger.info(f"{label} {job['state']}. Success: {job['sent']}, Failures: {job['failed']}")
+    await progress.update(job['sent'], job['failed'], job['state'], final=True)
+    if job['state'] in ('done', 'cancelled'):
+        await send_job_report(bot, job)
+        # The report has the failure details, only the job's counts are kept from here on
+        await run_db(database.delete_broadcast_recipients, job_id)
+
+async def run_job_logged(bot, job):
+    job_id = job['id']
+    try:
+        await run_job(bot, job)
+        _failures.pop(job_id, None)
+    except Exception as e:
+        failures = _failures[job_id] = _failures.get(job_id, 0) + 1
+        logger.error(f"Broadcast #{job_id} failed ({failures}/{JOB_MAX_FAILURES}): {e}")
+        if failures < JOB_MAX_FAILURES:
+            # The job stays runnable and is picked up again on the next poll
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            return
+        # Paused instead of retried forever, the admin can resume it once the cause is fixed
+        del _failures[job_id]
+        await run_db(database.set_broadcast_job_state, job_id, 'paused', ('pending', 'running'))
+        if job['report_chat_id']:
+            try:
+                await bot.send_message(
+                    chat_id=job['report_chat_id'],
+                    text=f"⚠️ Broadcast #{job_id} paused after {failures} failed runs: {e}\n"
+                         f"Resume it with /broadcast_resume {job_id}"
+                )
+            except Exception as e:
+                logger.error(f"Error reporting failed broadcast #{job_id}: {e}")
+
+async def prune_recipients():
+    """Drop the recipient rows of jobs finished more than JOB_RECIPIENT_RETENTION_DAYS ago.
+
+    Catches jobs cancelled while not running and jobs whose report failed.
+    """
+    try:
+        cutoff = datetime.now() - timedelta(days=JOB_RECIPIENT_RETENTION_DAYS)
+        deleted = await run_db(database.prune_broadcast_recipients, cutoff)
+        if deleted:
+            logger.info(f"Pruned {deleted} recipient rows of finished broadcasts")
+    except Exception as e:
+        logger.error(f"Error pruning broadcast recipients: {e}")
+
+async def run_jobs(bot):
+    """Background loop processing durable broadcast jobs.
+
+    Immediate jobs run one at a time, oldest first. Drip jobs are paced by
+    their own bucket and run alongside them, so a drip over several hours
+    does not hold up other broadcasts.
+    """
+    global _wakeup
+    _wakeup = asyncio.Event()
+    # job id -> (task, is drip job)
+    tasks = {}
+    next_prune = 0
+    try:
+        while not _shutting_down:
+            _wakeup.clear()
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + JOB_PRUNE_INTERVAL
+                await prune_recipients()
+            for job_id in [job_id for job_id, (task, _) in tasks.items() if task.done()]:
+                del tasks[job_id]
+            try:
+                immediate_running = any(not drip for _, drip in tasks.values())
+                for job in await run_db(database.get_runnable_broadcast_jobs):
+                    drip = bool(job['duration'])
+                    if job['id'] in tasks or (immediate_running and not drip):
+                        continue
+                    task = asyncio.create_task(run_job_logged(bot, job))
+                    task.add_done_callback(lambda task: wake_runner())
+                    tasks[job['id']] = (task, drip)
+                    immediate_running = immediate_running or not drip
+            except Exception as e:
+                logger.error(f"Broadcast job runner error: {e}")
+            try:
+                await asyncio.wait_for(_wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        # Running jobs were asked to stop and checkpoint
+        await asyncio.gather(*(task for task, _ in tasks.values()), return_exceptions=True)
+    except asyncio.CancelledError:
+        for task, _ in tasks.values():
+            task.cancel()
+        raise
+
+def start_runner(bot):
+    """Start the job runner task, resuming any job interrupted by a restart"""
+    global _runner_task, _shutting_down
+    _shutting_down = False
+    _runner_task = asyncio.create_task(run_jobs(bot))
+
+async def stop_runner(timeout=10):
+    """Let in-flight sends finish and checkpoint, then stop the job runner"""
+    global _runner_task, _shutting_down
+    if _runner_task is None:
+        return
+    _shutting_down = True
+    for stop in _running.values():
+        stop.set()
+    wake_runner()
+    try:
+        await asyncio.wait_for(_runner_task, timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Broadcast job runner did not stop in time, cancelling")
+        _runner_task.cancel()
+    except asyncio.CancelledError:
+        pass
+    _runner_task = None
@@ -0,0 +1,99 @@
+"""Run the verification poller once against stub_1win.py on a scratch database
+and check who it promotes and what it sends.
+
+Usage: python check_poller.py [port]
+"""
+import os
+import sys
+import logging
+import asyncio
+import tempfile
+from types import SimpleNamespace
+
+from aiohttp import web
+
+import database
+import bot
+import http_client
+import stub_1win
+
+# Stub API state: 2 and 6 registered, 3 and 4 deposited
+REGISTERED = {2, 6}
+DEPOSITS = {3: 50.0, 4: 20.0}
+
+class RecordingBot:
+    """Bot stand-in that records who was sent what"""
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(('message', chat_id, text))
+        return SimpleNamespace(message_id=len(self.sent))
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self.sent.append(('photo', chat_id, None))
+        return SimpleNamespace(message_id=len(self.sent), photo=[SimpleNamespace(file_id='deposit-photo')])
+
+def setup_database():
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), 'users.db')
+    database.init_db()
+    for user_id in range(1, 7):
+        database.create_user(user_id, f"user{user_id}")
+    database.apply_funnel_events([4], {})
+    # User 6 joined before join dates were recorded
+    database.get_connection().execute('UPDATE users SET created_at = NULL WHERE id = 6')
+    database.init_db()
+
+async def run(port):
+    runner = web.AppRunner(stub_1win.make_app(REGISTERED, DEPOSITS))
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    bot.ONEWIN_API_URL = f"http://127.0.0.1:{port}"
+    context = SimpleNamespace(bot=RecordingBot(), bot_data={})
+    try:
+        await bot.verify_pending_users_job(context)
+        first_run = list(context.bot.sent)
+        bot._verify_cache.clear()
+        await bot.verify_pending_users_job(context)
+    finally:
+        await http_client.close_session()
+        await runner.cleanup()
+    return first_run, context.bot.sent[len(first_run):]
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8099
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+    setup_database()
+    first_run, second_run = asyncio.run(run(port))
+
+    failures = []
+    def check(condition, message):
+        if not condition:
+            failures.append(message)
+
+    expected = {1: (0, 0), 2: (1, 0), 3: (1, 1), 4: (1, 1), 5: (0, 0), 6: (1, 0)}
+    for user_id, (registered, deposited) in expected.items():
+        record = database.get_user_record(user_id)
+        check((record['registered'], record['deposited']) == (registered, deposited),
+              f"user {user_id}: registered={record['registered']} deposited={record['deposited']}, "
+              f"expected {registered}/{deposited}")
+
+    user_sends = sorted((kind, chat_id) for kind, chat_id, _ in first_run if chat_id != bot.ADMIN_ID)
+    check(user_sends == [('message', 3), ('message', 4), ('photo', 2), ('photo', 3), ('photo', 6)],
+          f"unexpected user messages: {user_sends}")
+    reports = [text for _, chat_id, text in first_run if chat_id == bot.ADMIN_ID]
+    check(len(reports) == 1, f"expected one admin summary, got {len(reports)}")
+    if reports:
+        check("Registrations confirmed: 3" in reports[0] and "Deposits confirmed: 2" in reports[0],
+              f"unexpected admin summary: {reports[0]!r}")
+    check(not second_run, f"second run sent again: {second_run}")
+
+    database.shutdown_db()
+    if failures:
+        for failure in failures:
+            print(f"FAIL {failure}")
+        sys.exit(1)
+    print(f"OK: {len(first_run)} messages on the first run, none on the second")
+
+if __name__ == "__main__":
+    main()
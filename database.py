@@ -1,12 +1,162 @@
 import sqlite3
 import os
+import json
 import logging
+import asyncio
+import functools
+import threading
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
 
 DB_PATH = 'users.db'
+# Prepared statements kept per connection by the sqlite3 module
+STATEMENT_CACHE_SIZE = 256
+# Threads serving run_db, each keeps its own connection
+DB_WORKERS = int(os.getenv("DB_WORKERS", "1"))
+# Changed users fetched per round by get_changed_user_records
+SYNC_BATCH_SIZE = 500
+# SQLite limits bound parameters per statement, IN lists are chunked below it
+MAX_PARAMS = 900
+# Rows written per transaction by the bulk_* functions
+BULK_CHUNK_SIZE = 5000
+# Ids fetched per query while iterating a user segment
+SEGMENT_PAGE_SIZE = 5000
+
+# Secondary indexes on users, partial where a segment is small and hot
+USER_INDEXES = {
+    'idx_users_status': 'ON users (status)',
+    'idx_users_language': 'ON users (language)',
+    'idx_users_unregistered': 'ON users (id) WHERE registered = 0',
+    'idx_users_pending_deposit': 'ON users (id) WHERE registered = 1 AND deposited = 0',
+    'idx_users_vip': 'ON users (id) WHERE vip = 1',
+    'idx_users_approved': 'ON users (id) WHERE admin_approved = 1',
+    'idx_users_blocked': 'ON users (id) WHERE blocked = 1',
+}
+# Counters kept in user_counters, name -> flag column counted (None counts every user).
+# Tombstoned (blocked) users are only counted by 'blocked'.
+USER_COUNTERS = {
+    'total': None,
+    'registered': 'registered',
+    'deposited': 'deposited',
+    'vip': 'vip',
+    'approved': 'admin_approved',
+    'blocked': 'blocked',
+}
+
+# Columns added to the users table after its first release, in migration order
+USER_COLUMNS = [
+    ('vip', 'INTEGER DEFAULT 0'),
+    ('deposit_message_id', 'INTEGER'),
+    ('language', "TEXT DEFAULT 'en'"),
+    ('admin_approved', 'INTEGER DEFAULT 0'),
+    ('last_signal_message_id', 'INTEGER DEFAULT 0'),
+    ('registration_time', 'TEXT'),
+    ('deposit_time', 'TEXT'),
+    ('country', 'TEXT'),
+    ('amount', 'REAL'),
+    ('created_at', 'TEXT'),
+    ('blocked', 'INTEGER DEFAULT 0'),
+    ('blocked_reason', 'TEXT'),
+    ('blocked_at', 'TEXT'),
+]
+# Columns added to broadcast_jobs after its first release
+BROADCAST_JOB_COLUMNS = [
+    ('start_at', 'TEXT'),
+    ('duration', 'REAL'),
+]
+# Column values of a user row that has not been inserted yet
+NEW_USER_DEFAULTS = {
+    'username': None, 'registered': 0, 'status': 'Free', 'deposited': 0, 'vip': 0,
+    'deposit_message_id': None, 'language': 'en', 'admin_approved': 0, 'last_signal_message_id': 0,
+    'registration_time': None, 'deposit_time': None, 'country': None, 'amount': None, 'created_at': None,
+    'blocked': 0, 'blocked_reason': None, 'blocked_at': None,
+}
+# 0/1 columns
+FLAG_FIELDS = ('registered', 'deposited', 'vip', 'admin_approved', 'blocked')
+# Fields that upsert_user/update_user_fields may write
+USER_FIELDS = ('username', 'registered', 'status', 'deposited') + tuple(name for name, _ in USER_COLUMNS)
+
+logger = logging.getLogger(__name__)
+
+# One long-lived connection per thread, sqlite3 connections are not thread safe
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+# Queue of database calls from async handlers, served by dedicated DB threads
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+def get_connection():
+    """Return this thread's persistent connection, opening it on first use"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        # Autocommit mode, multi-statement flows use transaction()
+        conn = sqlite3.connect(
+            DB_PATH,
+            isolation_level=None,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=False  # only closed from another thread, see close_connections
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        _local.conn = conn
+        _local.depth = 0
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+@contextmanager
+def transaction():
+    """Run a block of statements in one transaction with a single commit.
+
+    Nested use joins the outermost transaction.
+    """
+    conn = get_connection()
+    if _local.depth:
+        _local.depth += 1
+        try:
+            yield conn
+        finally:
+            _local.depth -= 1
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    _local.depth = 1
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+    finally:
+        _local.depth = 0
+
+def close_connections():
+    """Close every connection opened by get_connection"""
+    with _connections_lock:
+        for conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.error(f"Error closing database connection: {e}")
+        _connections.clear()
+    _local.__dict__.clear()
+
+async def run_db(func, *args, **kwargs):
+    """Run a database function on the DB thread without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+def shutdown_db():
+    """Drain queued database calls and close all connections"""
+    _executor.shutdown(wait=True)
+    close_connections()
 
 def init_db():
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_connection()
         c = conn.cursor()
         c.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -19,104 +169,626 @@ def init_db():
         deposit_message_id INTEGER
     )
         ''')
-        
-        # Add deposit_message_id column if it doesn't exist
+
+        # Add any columns missing from older databases
         c.execute("PRAGMA table_info(users)")
         columns = [col[1] for col in c.fetchall()]
-        if 'deposit_message_id' not in columns:
-            c.execute('ALTER TABLE users ADD COLUMN deposit_message_id INTEGER')
-        
-        conn.commit()
+        for name, definition in USER_COLUMNS:
+            if name not in columns:
+                c.execute(f'ALTER TABLE users ADD COLUMN {name} {definition}')
+                if name == 'vip':
+                    # Deposited and upgraded users from before the column existed
+                    c.execute("UPDATE users SET vip = 1 WHERE deposited = 1 OR status = 'VIP'")
+        # Rows from older versions have no join date, it counts from the upgrade so pending users are still polled
+        c.execute('UPDATE users SET created_at = ? WHERE created_at IS NULL', (datetime.now().isoformat(),))
+
+        # Change log of user rows for incremental syncs, filled by triggers
+        c.execute('''
+    CREATE TABLE IF NOT EXISTS user_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL
+    )
+        ''')
+        c.execute('''
+    CREATE TABLE IF NOT EXISTS sync_state (
+        name TEXT PRIMARY KEY,
+        last_seq INTEGER NOT NULL
+    )
+        ''')
+        c.execute('''
+    CREATE TRIGGER IF NOT EXISTS users_changed_insert AFTER INSERT ON users
+    BEGIN
+        INSERT INTO user_changes (user_id) VALUES (NEW.id);
+    END
+        ''')
+        c.execute('''
+    CREATE TRIGGER IF NOT EXISTS users_changed_update AFTER UPDATE ON users
+    BEGIN
+        INSERT INTO user_changes (user_id) VALUES (NEW.id);
+    END
+        ''')
+
+        _init_user_counters(c)
+
+        for name, definition in USER_INDEXES.items():
+            c.execute(f'CREATE INDEX IF NOT EXISTS {name} {definition}')
+
+        # Durable broadcast jobs, recipients are snapshotted when the job is created
+        c.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        target TEXT,
+        state TEXT NOT NULL DEFAULT 'pending',
+        report_chat_id INTEGER,
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        cursor INTEGER DEFAULT 0,
+        created_at TEXT,
+        finished_at TEXT
+    )
+        ''')
+        c.execute("PRAGMA table_info(broadcast_jobs)")
+        columns = [col[1] for col in c.fetchall()]
+        for name, definition in BROADCAST_JOB_COLUMNS:
+            if name not in columns:
+                c.execute(f'ALTER TABLE broadcast_jobs ADD COLUMN {name} {definition}')
+        c.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        job_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        segment INTEGER NOT NULL DEFAULT 0,
+        outcome TEXT,
+        error TEXT,
+        PRIMARY KEY (job_id, seq)
+    ) WITHOUT ROWID
+        ''')
+        c.execute("PRAGMA table_info(broadcast_recipients)")
+        if 'segment' not in [col[1] for col in c.fetchall()]:
+            c.execute('ALTER TABLE broadcast_recipients ADD COLUMN segment INTEGER NOT NULL DEFAULT 0')
+
+        # Refresh planner statistics for new or grown indexes
+        c.execute('PRAGMA optimize')
     except sqlite3.Error as e:
         logger.error(f"Database initialization error: {e}")
-    finally:
-        if conn:
-            conn.close()
+
+def _counter_condition(column, row=None):
+    prefix = f'{row}.' if row else ''
+    if column == 'blocked':
+        return f'{prefix}blocked IS 1'
+    active = f'{prefix}blocked IS NOT 1'
+    return f'{active} AND {prefix}{column} IS 1' if column else active
+
+def _counter_delta(row):
+    """SQL CASE giving each counter's contribution of a NEW/OLD trigger row"""
+    whens = ' '.join(
+        f"WHEN '{name}' THEN ({_counter_condition(column, row)})"
+        for name, column in USER_COUNTERS.items()
+    )
+    return f'CASE name {whens} END'
+
+def _init_user_counters(c):
+    """Create the counters table and triggers, seeding counts on first use"""
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS user_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    c.execute('SELECT COUNT(*) FROM user_counters')
+    stale = c.fetchone()[0] != len(USER_COUNTERS)
+    if stale:
+        # The counter set changed, recreate the triggers for the new definitions
+        for trigger in ('users_counters_insert', 'users_counters_update', 'users_counters_delete'):
+            c.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS users_counters_insert AFTER INSERT ON users
+    BEGIN
+        UPDATE user_counters SET value = value + {_counter_delta('NEW')};
+    END
+    ''')
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS users_counters_update
+    AFTER UPDATE OF {', '.join(column for column in USER_COUNTERS.values() if column)} ON users
+    BEGIN
+        UPDATE user_counters SET value = value + {_counter_delta('NEW')} - {_counter_delta('OLD')};
+    END
+    ''')
+    c.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS users_counters_delete AFTER DELETE ON users
+    BEGIN
+        UPDATE user_counters SET value = value - {_counter_delta('OLD')};
+    END
+    ''')
+    if stale:
+        rebuild_user_counters()
+
+def rebuild_user_counters():
+    """Recount every counter from the users table"""
+    with transaction() as conn:
+        conn.execute('DELETE FROM user_counters')
+        for name, column in USER_COUNTERS.items():
+            conn.execute(
+                f'INSERT INTO user_counters (name, value) SELECT ?, COUNT(*) FROM users WHERE {_counter_condition(column)}',
+                (name,)
+            )
+
+def get_user_counters():
+    """Return the maintained user counters as a dict, O(1) in the number of users"""
+    c = get_connection().execute('SELECT name, value FROM user_counters')
+    return dict(c.fetchall())
 
 def get_user(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-    user = c.fetchone()
-    conn.close()
-    return user
+    c = get_connection().execute('SELECT * FROM users WHERE id = ?', (user_id,))
+    return c.fetchone()
 
 def create_user(user_id, username):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     try:
-        c.execute('INSERT INTO users (id, username, registered) VALUES (?, ?, 0)', 
-                 (user_id, username))
-        conn.commit()
+        get_connection().execute('INSERT INTO users (id, username, registered, created_at) VALUES (?, ?, 0, ?)',
+                                 (user_id, username, datetime.now().isoformat()))
     except sqlite3.IntegrityError:
         # User already exists
         pass
-    finally:
-        conn.close()
 
 def update_user_status(user_id, status):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('UPDATE users SET status = ? WHERE id = ?', (status, user_id))
-    conn.commit()
-    conn.close()
+    get_connection().execute('UPDATE users SET status = ? WHERE id = ?', (status, user_id))
 
 def mark_deposited(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('UPDATE users SET deposited = 1, vip = 1, status = "VIP" WHERE id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    get_connection().execute("UPDATE users SET deposited = 1, vip = 1, status = 'VIP' WHERE id = ?", (user_id,))
 
 def update_deposit_message_id(user_id, message_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('UPDATE users SET deposit_message_id = ? WHERE id = ?', (message_id, user_id))
-    conn.commit()
-    conn.close()
+    get_connection().execute('UPDATE users SET deposit_message_id = ? WHERE id = ?', (message_id, user_id))
 
 def get_deposit_message_id(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT deposit_message_id FROM users WHERE id = ?', (user_id,))
+    c = get_connection().execute('SELECT deposit_message_id FROM users WHERE id = ?', (user_id,))
     result = c.fetchone()
-    conn.close()
     return result[0] if result else None
 
-def get_all_users():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT id FROM users')
-    users = [row[0] for row in c.fetchall()]
-    conn.close()
-    return users
-
-def get_user_count():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users')
-    count = c.fetchone()[0]
-    conn.close()
-    return count
+def get_all_users(include_blocked=False):
+    """Return user ids, skipping tombstoned users unless include_blocked"""
+    sql = 'SELECT id FROM users' if include_blocked else 'SELECT id FROM users WHERE blocked = 0'
+    c = get_connection().execute(sql)
+    return [row[0] for row in c.fetchall()]
 
 def reset_user(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('UPDATE users SET status = "Free", deposited = 0, vip = 0 WHERE id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    get_connection().execute("UPDATE users SET status = 'Free', deposited = 0, vip = 0 WHERE id = ?", (user_id,))
 
 def mark_user_registered(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('UPDATE users SET registered = 1 WHERE id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    get_connection().execute('UPDATE users SET registered = 1 WHERE id = ?', (user_id,))
 
 def is_user_registered(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT registered FROM users WHERE id = ?', (user_id,))
+    c = get_connection().execute('SELECT registered FROM users WHERE id = ?', (user_id,))
     result = c.fetchone()
-    conn.close()
     return result[0] if result else False
+
+def _check_fields(fields):
+    for name in fields:
+        if name not in USER_FIELDS:
+            raise ValueError(f"Unknown user field: {name}")
+
+def _record(cursor, row):
+    return dict(zip([col[0] for col in cursor.description], row))
+
+def get_user_record(user_id):
+    """Return a user's full state as a dict, or None if unknown"""
+    c = get_connection().execute('SELECT * FROM users WHERE id = ?', (user_id,))
+    row = c.fetchone()
+    return _record(c, row) if row else None
+
+def upsert_user(user_id, **fields):
+    """Create a user or update the given fields, returns the full record"""
+    _check_fields(fields)
+    insert = {'created_at': datetime.now().isoformat(), **fields}
+    columns = ', '.join(['id', *insert])
+    placeholders = ', '.join('?' * (len(insert) + 1))
+    if fields:
+        conflict = 'DO UPDATE SET ' + ', '.join(f'{name} = excluded.{name}' for name in fields)
+    else:
+        conflict = 'DO NOTHING'
+    with transaction() as conn:
+        conn.execute(
+            f'INSERT INTO users ({columns}) VALUES ({placeholders}) ON CONFLICT(id) {conflict}',
+            (user_id, *insert.values())
+        )
+        return get_user_record(user_id)
+
+def update_user_fields(user_id, **fields):
+    """Update fields of an existing user, returns False if the user is unknown"""
+    _check_fields(fields)
+    if not fields:
+        return get_user_record(user_id) is not None
+    assignments = ', '.join(f'{name} = ?' for name in fields)
+    c = get_connection().execute(f'UPDATE users SET {assignments} WHERE id = ?', (*fields.values(), user_id))
+    return c.rowcount > 0
+
+def get_deposit_amount(user_id):
+    c = get_connection().execute('SELECT amount FROM users WHERE id = ?', (user_id,))
+    result = c.fetchone()
+    return result[0] if result else None
+
+def _segment_where(filters):
+    """Build a WHERE clause matching fields equal to the given values, None means any.
+
+    0/1 flags are inlined as literals so the planner can pick partial indexes.
+    """
+    filters = {name: value for name, value in filters.items() if value is not None}
+    _check_fields(filters)
+    conditions, params = [], []
+    for name, value in filters.items():
+        if name in FLAG_FIELDS:
+            conditions.append(f'{name} = {1 if value else 0}')
+        else:
+            conditions.append(f'{name} = ?')
+            params.append(value)
+    return conditions, params
+
+def iter_user_ids(registered=None, deposited=None, language=None, status=None, blocked=False,
+                  joined_before=None, joined_after=None, after_id=None, page_size=SEGMENT_PAGE_SIZE, **filters):
+    """Yield ids of users in a segment in id order, None filters match anything.
+
+    Tombstoned users are skipped unless blocked is None (any) or True (only them).
+    joined_before/joined_after compare ISO dates against created_at, after_id
+    resumes a walk after the last id seen.
+    Pages by id so no read transaction stays open between pages. Must be
+    consumed on the thread that created it, use get_user_ids from run_db.
+    """
+    conditions, params = _segment_where(dict(
+        registered=registered, deposited=deposited, language=language, status=status, blocked=blocked, **filters
+    ))
+    if joined_before is not None:
+        conditions.append('created_at < ?')
+        params.append(joined_before)
+    if joined_after is not None:
+        conditions.append('created_at >= ?')
+        params.append(joined_after)
+    sql = 'SELECT id FROM users WHERE ' + ' AND '.join(conditions + ['id > ?']) + ' ORDER BY id LIMIT ?'
+    conn = get_connection()
+    last_id = -1 if after_id is None else after_id
+    while True:
+        rows = conn.execute(sql, params + [last_id, page_size]).fetchall()
+        for (user_id,) in rows:
+            yield user_id
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][0]
+
+def get_user_ids(**filters):
+    """Return the ids of users in a segment, see iter_user_ids"""
+    return list(iter_user_ids(**filters))
+
+def get_user_id_page(limit, **filters):
+    """Return up to limit ids of users in a segment, see iter_user_ids"""
+    return list(islice(iter_user_ids(page_size=limit, **filters), limit))
+
+def get_all_user_records():
+    """Return every user record as a dict, ordered by id"""
+    c = get_connection().execute('SELECT * FROM users ORDER BY id')
+    return [_record(c, row) for row in c.fetchall()]
+
+def import_users(records):
+    """Merge users.json style records into the users table in batched transactions.
+
+    Registration and deposit flags are never downgraded; other fields present
+    in a record overwrite the stored value, missing ones leave it alone.
+    Returns the number of records.
+    """
+    fields = ('username', 'registered', 'deposited', 'language', 'admin_approved',
+              'last_signal_message_id', 'registration_time', 'deposit_time', 'country', 'amount')
+    now = datetime.now().isoformat()
+    # New users are created with the column defaults, then every record is merged the same way
+    insert = 'INSERT OR IGNORE INTO users (id, created_at) VALUES (?, ?)'
+    assignments = ', '.join(
+        f'{name} = MAX(COALESCE(?, {name}), {name})' if name in ('registered', 'deposited')
+        else f'{name} = COALESCE(?, {name})'
+        for name in fields
+    )
+    update = f'UPDATE users SET {assignments} WHERE id = ?'
+    processed = 0
+    for chunk in _chunks(records):
+        with transaction() as conn:
+            conn.executemany(insert, ((user['id'], now) for user in chunk))
+            conn.executemany(update, ((*(user.get(name) for name in fields), user['id']) for user in chunk))
+        processed += len(chunk)
+    return processed
+
+def get_user_records(user_ids):
+    """Return the records of the given users, unknown ids are skipped"""
+    user_ids = list(user_ids)
+    conn = get_connection()
+    records = []
+    for i in range(0, len(user_ids), MAX_PARAMS):
+        chunk = user_ids[i:i + MAX_PARAMS]
+        c = conn.execute(f'SELECT * FROM users WHERE id IN ({", ".join("?" * len(chunk))})', chunk)
+        records.extend(_record(c, row) for row in c.fetchall())
+    return records
+
+def snapshot_user_records():
+    """Return every user record together with the change sequence it reflects"""
+    with transaction() as conn:
+        seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM user_changes').fetchone()[0]
+        return get_all_user_records(), seq
+
+def get_changed_user_records(since_seq, limit=SYNC_BATCH_SIZE):
+    """Return (records, last_seq) for users changed after since_seq.
+
+    last_seq equals since_seq when nothing changed.
+    """
+    with transaction() as conn:
+        rows = conn.execute(
+            'SELECT seq, user_id FROM user_changes WHERE seq > ? ORDER BY seq LIMIT ?',
+            (since_seq, limit)
+        ).fetchall()
+        if not rows:
+            return [], since_seq
+        return get_user_records({user_id for _, user_id in rows}), rows[-1][0]
+
+def get_sync_watermark(name):
+    """Return the last change sequence a sync consumer has applied, or None"""
+    row = get_connection().execute('SELECT last_seq FROM sync_state WHERE name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+def set_sync_watermark(name, seq):
+    """Store a consumer's watermark and drop change log entries every consumer has applied"""
+    with transaction() as conn:
+        conn.execute(
+            'INSERT INTO sync_state (name, last_seq) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET last_seq = excluded.last_seq',
+            (name, seq)
+        )
+        conn.execute('DELETE FROM user_changes WHERE seq <= (SELECT MIN(last_seq) FROM sync_state)')
+
+def _chunks(iterable, size=BULK_CHUNK_SIZE):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _bulk_execute(sql, rows):
+    """executemany rows in one transaction per BULK_CHUNK_SIZE rows, returns rows processed.
+
+    Committing per chunk bounds how long interactive writes wait on the lock.
+    """
+    processed = 0
+    for chunk in _chunks(rows):
+        with transaction() as conn:
+            conn.executemany(sql, chunk)
+        processed += len(chunk)
+    return processed
+
+def bulk_upsert_users(records):
+    """Create or update many users from dicts with an 'id' and any USER_FIELDS"""
+    processed = 0
+    for chunk in _chunks(records):
+        # executemany needs one statement per distinct set of fields
+        groups = {}
+        for record in chunk:
+            fields = tuple(name for name in record if name != 'id')
+            groups.setdefault(fields, []).append(record)
+        now = datetime.now().isoformat()
+        with transaction() as conn:
+            for fields, group in groups.items():
+                _check_fields(fields)
+                insert = fields if 'created_at' in fields else fields + ('created_at',)
+                columns = ', '.join(['id', *insert])
+                placeholders = ', '.join('?' * (len(insert) + 1))
+                if fields:
+                    conflict = 'DO UPDATE SET ' + ', '.join(f'{name} = excluded.{name}' for name in fields)
+                else:
+                    conflict = 'DO NOTHING'
+                conn.executemany(
+                    f'INSERT INTO users ({columns}) VALUES ({placeholders}) ON CONFLICT(id) {conflict}',
+                    [(record['id'], *(record.get(name, now) for name in insert)) for record in group]
+                )
+        processed += len(chunk)
+    return processed
+
+def bulk_mark_blocked(user_ids, blocked=True):
+    """Flag many users as having blocked the bot (or clear the flag)"""
+    if not blocked:
+        return _bulk_execute(
+            'UPDATE users SET blocked = 0, blocked_reason = NULL, blocked_at = NULL WHERE id = ?',
+            ((user_id,) for user_id in user_ids)
+        )
+    return record_tombstones((user_id, 'blocked') for user_id in user_ids)
+
+def record_tombstones(tombstones):
+    """Mark (user_id, reason) pairs as permanently unreachable, keeping the first reason and time"""
+    now = datetime.now().isoformat()
+    return _bulk_execute(
+        'UPDATE users SET blocked = 1, blocked_reason = COALESCE(blocked_reason, ?), '
+        'blocked_at = COALESCE(blocked_at, ?) WHERE id = ?',
+        ((reason, now, user_id) for user_id, reason in tombstones)
+    )
+
+def get_tombstone_counts():
+    """Return the number of tombstoned users per reason"""
+    c = get_connection().execute(
+        'SELECT blocked_reason, COUNT(*) FROM users WHERE blocked = 1 GROUP BY blocked_reason'
+    )
+    return {reason or 'blocked': count for reason, count in c.fetchall()}
+
+def bulk_set_status(user_ids, status):
+    """Set the status of many users"""
+    return _bulk_execute('UPDATE users SET status = ? WHERE id = ?', ((status, user_id) for user_id in user_ids))
+
+def bulk_approve(user_ids, approved=True):
+    """Set admin approval for many users, creating unknown users"""
+    value = 1 if approved else 0
+    now = datetime.now().isoformat()
+    return _bulk_execute(
+        'INSERT INTO users (id, admin_approved, created_at) VALUES (?, ?, ?) '
+        'ON CONFLICT(id) DO UPDATE SET admin_approved = excluded.admin_approved',
+        ((user_id, value, now) for user_id in user_ids)
+    )
+
+def apply_funnel_events(registered_ids, deposits):
+    """Record registration and deposit postbacks in one transaction, never downgrading.
+
+    deposits maps user id -> amount, a deposit implies registration. Unknown
+    users are created. Returns (newly registered ids, newly deposited ids).
+    """
+    now = datetime.now().isoformat()
+    registered, deposited = [], []
+    with transaction() as conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO users (id, created_at) VALUES (?, ?)',
+            ((user_id, now) for user_id in set(registered_ids) | set(deposits))
+        )
+        for user_id in dict.fromkeys([*registered_ids, *deposits]):
+            c = conn.execute(
+                'UPDATE users SET registered = 1, registration_time = ? WHERE id = ? AND registered = 0', (now, user_id)
+            )
+            if c.rowcount:
+                registered.append(user_id)
+        for user_id, amount in deposits.items():
+            c = conn.execute(
+                "UPDATE users SET deposited = 1, deposit_time = ?, amount = ?, vip = 1, status = 'VIP' "
+                'WHERE id = ? AND deposited = 0', (now, amount, user_id)
+            )
+            if c.rowcount:
+                deposited.append(user_id)
+    return registered, deposited
+
+def _broadcast_job(cursor, row):
+    job = _record(cursor, row)
+    job['payload'] = json.loads(job['payload'])
+    job['target'] = json.loads(job['target']) if job['target'] else None
+    return job
+
+def _insert_broadcast_job(conn, kind, payload, target, report_chat_id, recipients, start_at=None, duration=None):
+    """Insert a job and its (user_id, segment) recipients, returns (job_id, total)"""
+    c = conn.execute(
+        'INSERT INTO broadcast_jobs (kind, payload, target, report_chat_id, created_at, start_at, duration) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        (kind, json.dumps(payload), json.dumps(target) if target is not None else None,
+         report_chat_id, datetime.now().isoformat(), start_at.isoformat() if start_at else None, duration)
+    )
+    job_id = c.lastrowid
+    total = 0
+    for chunk in _chunks(enumerate(recipients, start=1)):
+        conn.executemany(
+            'INSERT INTO broadcast_recipients (job_id, seq, user_id, segment) VALUES (?, ?, ?, ?)',
+            [(job_id, seq, user_id, segment) for seq, (user_id, segment) in chunk]
+        )
+        total += len(chunk)
+    conn.execute('UPDATE broadcast_jobs SET total = ? WHERE id = ?', (total, job_id))
+    return job_id, total
+
+def create_broadcast_job(kind, payload, user_ids, report_chat_id=None, target=None, start_at=None, duration=None):
+    """Store a broadcast job with its recipient list, returns (job_id, total).
+
+    A job with a start_at datetime is not run before it; with a duration in
+    seconds its sends are spread evenly until start_at + duration.
+    """
+    with transaction() as conn:
+        return _insert_broadcast_job(
+            conn, kind, payload, target, report_chat_id, ((user_id, 0) for user_id in user_ids), start_at, duration
+        )
+
+def create_segmented_broadcast_job(kind, payload, segments, report_chat_id=None, start_at=None, duration=None):
+    """Store a job whose recipients are selected by a list of iter_user_ids filter dicts.
+
+    A user matching several segments is sent only the first one. Returns
+    (job_id, per-segment recipient counts). See create_broadcast_job for
+    start_at and duration.
+    """
+    counts = [0] * len(segments)
+    seen = set()
+
+    def recipients():
+        for segment, filters in enumerate(segments):
+            for user_id in iter_user_ids(**filters):
+                if user_id not in seen:
+                    seen.add(user_id)
+                    counts[segment] += 1
+                    yield user_id, segment
+
+    with transaction() as conn:
+        job_id, _ = _insert_broadcast_job(
+            conn, kind, payload, segments, report_chat_id, recipients(), start_at, duration
+        )
+    return job_id, counts
+
+def get_broadcast_job(job_id):
+    c = get_connection().execute('SELECT * FROM broadcast_jobs WHERE id = ?', (job_id,))
+    row = c.fetchone()
+    return _broadcast_job(c, row) if row else None
+
+def list_broadcast_jobs(limit=10):
+    """Return the most recent broadcast jobs, newest first"""
+    c = get_connection().execute('SELECT * FROM broadcast_jobs ORDER BY id DESC LIMIT ?', (limit,))
+    return [_broadcast_job(c, row) for row in c.fetchall()]
+
+def get_runnable_broadcast_jobs():
+    """Return the jobs that are due and waiting, or were interrupted mid-run, oldest first"""
+    c = get_connection().execute(
+        "SELECT * FROM broadcast_jobs WHERE state IN ('pending', 'running') "
+        "AND (start_at IS NULL OR start_at <= ?) ORDER BY id",
+        (datetime.now().isoformat(),)
+    )
+    return [_broadcast_job(c, row) for row in c.fetchall()]
+
+def set_broadcast_job_state(job_id, state, from_states=None):
+    """Move a job to `state`, optionally only from one of `from_states`. Returns True if it moved."""
+    sql = 'UPDATE broadcast_jobs SET state = ?, finished_at = ? WHERE id = ?'
+    finished_at = datetime.now().isoformat() if state in ('done', 'cancelled') else None
+    params = [state, finished_at, job_id]
+    if from_states:
+        sql += f' AND state IN ({", ".join("?" * len(from_states))})'
+        params.extend(from_states)
+    return get_connection().execute(sql, params).rowcount > 0
+
+def get_pending_recipients(job_id, after_seq, limit):
+    """Return (seq, user_id, segment) rows without an outcome yet, after the job cursor"""
+    c = get_connection().execute(
+        'SELECT seq, user_id, segment FROM broadcast_recipients '
+        'WHERE job_id = ? AND seq > ? AND outcome IS NULL ORDER BY seq LIMIT ?',
+        (job_id, after_seq, limit)
+    )
+    return c.fetchall()
+
+def record_broadcast_outcomes(job_id, outcomes, cursor):
+    """Store (seq, outcome, error) results of a batch and advance the job cursor"""
+    sent = sum(1 for _, outcome, _ in outcomes if outcome == 'sent')
+    with transaction() as conn:
+        conn.executemany(
+            'UPDATE broadcast_recipients SET outcome = ?, error = ? WHERE job_id = ? AND seq = ?',
+            [(outcome, error, job_id, seq) for seq, outcome, error in outcomes]
+        )
+        conn.execute(
+            'UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ?, cursor = ? WHERE id = ?',
+            (sent, len(outcomes) - sent, cursor, job_id)
+        )
+
+def count_broadcast_outcomes(job_id):
+    """Return the number of recipients of a job per recorded outcome"""
+    c = get_connection().execute(
+        'SELECT outcome, COUNT(*) FROM broadcast_recipients WHERE job_id = ? AND outcome IS NOT NULL GROUP BY outcome',
+        (job_id,)
+    )
+    return dict(c.fetchall())
+
+def delete_broadcast_recipients(job_id):
+    """Drop the recipient rows of a job, its sent and failed counts stay on the job"""
+    get_connection().execute('DELETE FROM broadcast_recipients WHERE job_id = ?', (job_id,))
+
+def prune_broadcast_recipients(finished_before):
+    """Drop the recipient rows of done or cancelled jobs finished before a datetime, returns the rows deleted"""
+    c = get_connection().execute(
+        "DELETE FROM broadcast_recipients WHERE job_id IN "
+        "(SELECT id FROM broadcast_jobs WHERE state IN ('done', 'cancelled') AND finished_at < ?)",
+        (finished_before.isoformat(),)
+    )
+    return c.rowcount
+
+def get_broadcast_failures(job_id, limit=10):
+    """Return (user_id, error) for failed recipients of a job"""
+    c = get_connection().execute(
+        "SELECT user_id, error FROM broadcast_recipients WHERE job_id = ? AND outcome = 'failed' ORDER BY seq LIMIT ?",
+        (job_id, limit)
+    )
+    return c.fetchall()
@@ -0,0 +1,43 @@
+import os
+import logging
+import aiohttp
+
+# Connections kept open in total and per host (api.1win.com, api.telegram.org)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "20"))
+# Seconds an idle keep-alive connection stays in the pool
+HTTP_KEEPALIVE = 30
+# Seconds DNS lookups are cached
+HTTP_DNS_TTL = 300
+# Default total timeout of a request in seconds
+HTTP_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+# Application-scoped client, opened in post_init and closed in post_shutdown
+_session = None
+
+def open_session():
+    """Create the shared client session with a bounded keep-alive connection pool"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ttl_dns_cache=HTTP_DNS_TTL,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+    return _session
+
+def session():
+    """Return the shared client session, opening it on first use"""
+    return open_session()
+
+async def close_session():
+    """Close the shared client session and its pooled connections"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("HTTP client session closed")
+    _session = None
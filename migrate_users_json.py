@@ -0,0 +1,29 @@
+"""One-shot import of users.json (plus any pending journal) into users.db.
+
+Usage: python migrate_users_json.py [users.json]
+"""
+import sys
+import logging
+
+import database
+import user_store
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+def main():
+    filename = sys.argv[1] if len(sys.argv) > 1 else user_store.USERS_FILE
+    database.init_db()
+    user_store.load_users(filename)
+    records = user_store.all_records()
+    before = database.get_user_counters()['total']
+    imported = database.import_users(records)
+    after = database.get_user_counters()['total']
+    logger.info(f"Imported {imported} users from {filename}: {after - before} new, {imported - (after - before)} merged")
+    database.close_connections()
+    user_store.close()
+
+if __name__ == "__main__":
+    main()
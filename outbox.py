@@ -0,0 +1,143 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+# Messages/sec shared by every outbound Bot API call, Telegram allows about 30
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "30"))
+# Relative share of send slots per lane while several lanes are waiting
+LANE_WEIGHTS = {
+    'interactive': 6,  # replies to a user's own click or command
+    'admin': 3,        # replies and reports to the admin
+    'bulk': 1,         # broadcasts
+}
+# rate_limit_args lane of calls whose slot was already taken with outbox.acquire
+PREACQUIRED = 'preacquired'
+
+logger = logging.getLogger(__name__)
+
+class Outbox:
+    """Shared send budget with priority lanes.
+
+    Tokens refill at `rate` per second. While several lanes have waiters, send
+    slots are handed out by smooth weighted round robin over LANE_WEIGHTS, and
+    a lone lane may use the whole budget.
+    """
+
+    def __init__(self, rate, weights=LANE_WEIGHTS, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.weights = dict(weights)
+        self.granted = {lane: 0 for lane in weights}
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lanes = {lane: deque() for lane in weights}
+        self._credit = {lane: 0 for lane in weights}
+        self._loop = None
+        self._task = None
+        self._wakeup = None
+
+    def _ensure_dispatcher(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._dispatch())
+
+    async def acquire(self, lane='bulk'):
+        """Wait for a send slot in `lane`"""
+        self._ensure_dispatcher()
+        waiter = self._loop.create_future()
+        self._lanes[lane].append(waiter)
+        self._wakeup.set()
+        await waiter
+
+    def pause(self, seconds):
+        """Stop handing out slots for `seconds`, e.g. after a RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    def waiting(self):
+        """Return the number of waiters per lane"""
+        return {lane: len(waiters) for lane, waiters in self._lanes.items()}
+
+    def _next_lane(self, waiting):
+        total = sum(self.weights[lane] for lane in waiting)
+        for lane in waiting:
+            self._credit[lane] += self.weights[lane]
+        lane = max(waiting, key=self._credit.get)
+        self._credit[lane] -= total
+        return lane
+
+    async def _dispatch(self):
+        while True:
+            # Waiters cancelled while queued (e.g. a stopped broadcast) give up their place
+            for waiters in self._lanes.values():
+                while waiters and waiters[0].done():
+                    waiters.popleft()
+            waiting = [lane for lane, waiters in self._lanes.items() if waiters]
+            if not waiting:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            lane = self._next_lane(waiting)
+            self._tokens -= 1
+            self.granted[lane] += 1
+            self._lanes[lane].popleft().set_result(None)
+
+    def close(self):
+        """Stop the dispatcher"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+# Every outbound call of the bot shares this budget
+outbox = Outbox(OUTBOX_RATE)
+
+class OutboxRateLimiter(BaseRateLimiter):
+    """Routes every Bot API call through the outbox.
+
+    The lane comes from rate_limit_args={'lane': ...}, otherwise calls to the
+    admin chat use the admin lane and everything else the interactive lane.
+    Calls without a chat (answerCallbackQuery, getMe...) bypass the outbox,
+    they count against no per-chat limit and must not hang while it is paused.
+    """
+
+    def __init__(self, admin_id):
+        self.admin_id = str(admin_id)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        outbox.close()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = (rate_limit_args or {}).get('lane')
+        chat_id = (data or {}).get('chat_id')
+        if lane is None:
+            if chat_id is None:
+                return await callback(*args, **kwargs)
+            lane = 'admin' if str(chat_id) == self.admin_id else 'interactive'
+        if lane != PREACQUIRED:
+            await outbox.acquire(lane)
+        try:
+            return await callback(*args, **kwargs)
+        except RetryAfter as e:
+            logger.warning(f"{endpoint} rate limited in the {lane} lane, pausing the outbox for {e.retry_after}s")
+            outbox.pause(e.retry_after)
+            raise
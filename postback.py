@@ -0,0 +1,164 @@
+import os
+import hmac
+import math
+import sqlite3
+import asyncio
+import logging
+from aiohttp import web
+
+# Shared secret 1win sends with every postback, the endpoint stays off without it
+POSTBACK_SECRET = os.getenv("POSTBACK_SECRET", "")
+# Render routes the service's public port to $PORT
+POSTBACK_PORT = int(os.getenv("PORT", "8080"))
+POSTBACK_PATH = "/postback"
+# Events buffered between the endpoint and the database, a full queue answers 503 so 1win retries
+POSTBACK_QUEUE_SIZE = int(os.getenv("POSTBACK_QUEUE_SIZE", "10000"))
+# Events applied per batch, and seconds to wait for a batch to fill up
+POSTBACK_BATCH_SIZE = 500
+POSTBACK_FLUSH_INTERVAL = 1.0
+# Attempts at a batch failing for other reasons than a busy database, before it is split to isolate the bad event
+POSTBACK_ATTEMPTS = 3
+# Seconds between attempts at a failed batch, doubled up to the maximum
+POSTBACK_RETRY_DELAY = 1
+POSTBACK_RETRY_MAX_DELAY = 30
+# Telegram user ids fit a signed 64 bit SQLite integer
+MAX_USER_ID = 2 ** 63 - 1
+POSTBACK_EVENTS = ('registration', 'deposit')
+
+logger = logging.getLogger(__name__)
+
+_queue = None
+_closing = None
+_web_runner = None
+_batch_task = None
+# Counters shown in the logs when the server stops
+stats = {'accepted': 0, 'rejected': 0, 'busy': 0, 'applied': 0, 'dropped': 0}
+
+def parse_postback(params):
+    """Return a postback's event as a dict, raises ValueError if it is malformed"""
+    event = str(params.get('event', '')).lower()
+    if event not in POSTBACK_EVENTS:
+        raise ValueError(f"unknown event {event!r}")
+    # The bot puts the Telegram user id into the sub1 parameter of its 1win links
+    user_id = int(str(params.get('user_id') or params.get('sub1') or ''))
+    if not 1 <= user_id <= MAX_USER_ID:
+        raise ValueError(f"user id {user_id} out of range")
+    amount = float(str(params.get('amount') or 0))
+    if not math.isfinite(amount):
+        raise ValueError(f"invalid amount {amount}")
+    return {'event': event, 'user_id': user_id, 'amount': amount}
+
+async def handle_postback(request):
+    params = dict(request.query)
+    try:
+        if request.method == 'POST':
+            if request.content_type == 'application/json':
+                params.update(await request.json())
+            else:
+                params.update(await request.post())
+    except (ValueError, TypeError):
+        stats['rejected'] += 1
+        return web.Response(status=400, text="bad postback body")
+    secret = request.headers.get('X-Postback-Secret') or params.pop('secret', '')
+    if not hmac.compare_digest(str(secret).encode(), POSTBACK_SECRET.encode()):
+        stats['rejected'] += 1
+        return web.Response(status=403, text="forbidden")
+    try:
+        event = parse_postback(params)
+    except (ValueError, TypeError) as e:
+        stats['rejected'] += 1
+        return web.Response(status=400, text=f"bad postback: {e}")
+    try:
+        _queue.put_nowait(event)
+    except asyncio.QueueFull:
+        stats['busy'] += 1
+        return web.Response(status=503, text="busy")
+    stats['accepted'] += 1
+    return web.Response(text="ok")
+
+async def _next_batch():
+    """Wait for events, then collect more for up to POSTBACK_FLUSH_INTERVAL"""
+    loop = asyncio.get_running_loop()
+    events = []
+    deadline = None
+    try:
+        while len(events) < POSTBACK_BATCH_SIZE:
+            timeout = POSTBACK_FLUSH_INTERVAL if deadline is None else deadline - loop.time()
+            if timeout <= 0:
+                break
+            events.append(await asyncio.wait_for(_queue.get(), timeout))
+            if deadline is None:
+                deadline = loop.time() + POSTBACK_FLUSH_INTERVAL
+    except asyncio.TimeoutError:
+        pass
+    return events
+
+async def _apply_with_retries(apply_batch, events):
+    """Apply acknowledged events until they stick, only a single event failing every attempt is dropped.
+
+    A busy or locked database is retried for as long as it takes, meanwhile
+    the queue fills up and the endpoint answers 503. Other errors split the
+    batch so one malformed event does not cost the rest.
+    """
+    attempts = 0
+    delay = POSTBACK_RETRY_DELAY
+    while True:
+        try:
+            await apply_batch(events)
+            stats['applied'] += len(events)
+            return
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Database busy applying {len(events)} postbacks, retrying in {delay}s: {e}")
+        except Exception as e:
+            attempts += 1
+            logger.error(f"Error applying {len(events)} postbacks (attempt {attempts}/{POSTBACK_ATTEMPTS}): {e}")
+            if attempts >= POSTBACK_ATTEMPTS:
+                if len(events) == 1:
+                    stats['dropped'] += 1
+                    logger.error(f"Dropping postback {events[0]}")
+                    return
+                middle = len(events) // 2
+                await _apply_with_retries(apply_batch, events[:middle])
+                await _apply_with_retries(apply_batch, events[middle:])
+                return
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, POSTBACK_RETRY_MAX_DELAY)
+
+async def _apply_batches(apply_batch):
+    while not (_closing.is_set() and _queue.empty()):
+        events = await _next_batch()
+        if events:
+            await _apply_with_retries(apply_batch, events)
+
+async def start_postback_server(apply_batch):
+    """Serve POSTBACK_PATH and hand queued events to apply_batch(events) in batches"""
+    global _queue, _closing, _web_runner, _batch_task
+    if not POSTBACK_SECRET:
+        logger.warning("POSTBACK_SECRET is not set, the postback endpoint is disabled")
+        return
+    _queue = asyncio.Queue(POSTBACK_QUEUE_SIZE)
+    _closing = asyncio.Event()
+    _batch_task = asyncio.create_task(_apply_batches(apply_batch))
+    app = web.Application()
+    app.router.add_route('GET', POSTBACK_PATH, handle_postback)
+    app.router.add_route('POST', POSTBACK_PATH, handle_postback)
+    _web_runner = web.AppRunner(app, access_log=None)
+    await _web_runner.setup()
+    await web.TCPSite(_web_runner, port=POSTBACK_PORT).start()
+    logger.info(f"Postback endpoint listening on port {POSTBACK_PORT}{POSTBACK_PATH}")
+
+async def stop_postback_server(timeout=10):
+    """Stop accepting postbacks and apply the ones still queued"""
+    global _web_runner, _batch_task
+    if _web_runner is None:
+        return
+    await _web_runner.cleanup()
+    _web_runner = None
+    _closing.set()
+    try:
+        await asyncio.wait_for(_batch_task, timeout)
+    except asyncio.TimeoutError:
+        # A batch still being retried is lost as well
+        logger.warning(f"Postbacks not applied before shutdown: {_queue.qsize()} queued")
+    _batch_task = None
+    logger.info(f"Postback endpoint stopped: {stats}")
@@ -0,0 +1,47 @@
+"""Stand-in for the 1win verification API for local runs of the bot.
+
+Registered users are given as ids, deposited users as id:amount. Deposited
+users count as registered too.
+
+Usage: python stub_1win.py [--port 8081] [--registered 1,2] [--deposited 2:50,3:10]
+Then start the bot with ONEWIN_API_URL=http://localhost:8081
+"""
+import argparse
+
+from aiohttp import web
+
+def parse_ids(value):
+    return {int(user_id) for user_id in value.split(',') if user_id}
+
+def parse_deposits(value):
+    deposits = {}
+    for entry in value.split(','):
+        if entry:
+            user_id, _, amount = entry.partition(':')
+            deposits[int(user_id)] = float(amount or 0)
+    return deposits
+
+def make_app(registered, deposits):
+    async def verify_registration(request):
+        user_id = int(request.match_info['user_id'])
+        return web.json_response({'registered': user_id in registered or user_id in deposits})
+
+    async def verify_deposit(request):
+        user_id = int(request.match_info['user_id'])
+        return web.json_response({'deposited': user_id in deposits, 'amount': deposits.get(user_id, 0.0)})
+
+    app = web.Application()
+    app.router.add_get('/verify-registration/{user_id}', verify_registration)
+    app.router.add_get('/verify-deposit/{user_id}', verify_deposit)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub 1win verification API")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--registered', type=parse_ids, default=set())
+    parser.add_argument('--deposited', type=parse_deposits, default={})
+    args = parser.parse_args()
+    web.run_app(make_app(args.registered, args.deposited), port=args.port)
+
+if __name__ == "__main__":
+    main()
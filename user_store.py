@@ -0,0 +1,180 @@
+import json
+import os
+import logging
+import threading
+
+USERS_FILE = "users.json"
+# Append-only mutation journal replayed on top of users.json at startup
+JOURNAL_FILE = "users.journal"
+# Seconds between checks whether the journal should be compacted
+COMPACT_INTERVAL = int(os.getenv("USER_STORE_COMPACT_INTERVAL", "60"))
+# Journal size in bytes after which it is folded into a fresh users.json snapshot
+COMPACT_THRESHOLD = int(os.getenv("USER_STORE_COMPACT_THRESHOLD", str(1024 * 1024)))
+
+logger = logging.getLogger(__name__)
+
+# Process-wide user store: user id -> user record, insertion ordered like users.json
+_users = {}
+_loaded = False
+_journal = None
+_lock = threading.RLock()
+_MISSING = object()
+
+def _compacting_filename(journal_filename):
+    return f"{journal_filename}.compacting"
+
+def _replay_journal(users, filename):
+    """Apply journal entries from filename to users, returns number of entries"""
+    if not os.path.exists(filename):
+        return 0
+    count = 0
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A torn final line from a crash mid-write, everything before it is intact
+                logger.warning(f"Skipping corrupt journal entry in {filename}")
+                continue
+            user = users.setdefault(entry['id'], {"id": entry['id']})
+            user.update(entry['set'])
+            count += 1
+    return count
+
+def load_users(filename=USERS_FILE, journal_filename=JOURNAL_FILE):
+    """Load the users.json snapshot and replay the journal once at startup"""
+    global _users, _loaded, _journal
+    with _lock:
+        users = {}
+        try:
+            if os.path.exists(filename):
+                with open(filename, 'r', encoding='utf-8') as f:
+                    for user in json.load(f):
+                        users[user['id']] = user
+        except Exception as e:
+            logger.error(f"Error loading {filename}: {e}")
+        replayed = 0
+        try:
+            # An interrupted compaction leaves its journal behind, replay it first
+            replayed += _replay_journal(users, _compacting_filename(journal_filename))
+            replayed += _replay_journal(users, journal_filename)
+        except Exception as e:
+            logger.error(f"Error replaying {journal_filename}: {e}")
+        if _journal is not None:
+            _journal.close()
+        _journal = open(journal_filename, 'a', encoding='utf-8')
+        _users = users
+        _loaded = True
+        logger.info(f"Loaded {len(_users)} users from {filename} ({replayed} journal entries replayed)")
+        return len(_users)
+
+def _ensure_loaded():
+    if not _loaded:
+        load_users()
+
+def _append_journal(user_id, fields):
+    try:
+        _journal.write(json.dumps({"id": user_id, "set": fields}, ensure_ascii=False) + "\n")
+        _journal.flush()
+    except Exception as e:
+        logger.error(f"Error writing journal entry for {user_id}: {e}")
+
+def get_record(user_id):
+    """Return the stored record for a user, or None if unknown"""
+    with _lock:
+        _ensure_loaded()
+        return _users.get(user_id)
+
+def update_record(user_id, defaults=None, **fields):
+    """Update fields on a user record.
+
+    If the user is unknown and ``defaults`` is given, a new record is created
+    from ``defaults`` first. Returns False if the user does not exist and no
+    defaults were provided.
+    """
+    with _lock:
+        _ensure_loaded()
+        user = _users.get(user_id)
+        if user is None:
+            if defaults is None:
+                return False
+            user = {"id": user_id}
+            _users[user_id] = user
+            fields = {**defaults, **fields}
+        else:
+            # Only journal fields whose value actually changes
+            fields = {key: value for key, value in fields.items() if user.get(key, _MISSING) != value}
+            if not fields:
+                return True
+        user.update(fields)
+        _append_journal(user_id, fields)
+        return True
+
+def all_user_ids():
+    """Return all known user IDs"""
+    with _lock:
+        _ensure_loaded()
+        return list(_users)
+
+def all_records():
+    """Return a snapshot list of all user records"""
+    with _lock:
+        _ensure_loaded()
+        return list(_users.values())
+
+def journal_size(journal_filename=JOURNAL_FILE):
+    """Return the current journal size in bytes"""
+    try:
+        return os.path.getsize(journal_filename)
+    except OSError:
+        return 0
+
+def needs_compaction():
+    """Return True once the journal has grown past COMPACT_THRESHOLD"""
+    return journal_size() >= COMPACT_THRESHOLD
+
+def compact(filename=USERS_FILE, journal_filename=JOURNAL_FILE):
+    """Fold the journal into a fresh users.json snapshot.
+
+    Only the journal rotation happens under the lock; the snapshot is written
+    afterwards so this can run in a worker thread while updates continue.
+    """
+    global _journal
+    compacting = _compacting_filename(journal_filename)
+    with _lock:
+        _ensure_loaded()
+        if os.path.exists(compacting):
+            logger.warning(f"Previous compaction of {journal_filename} did not finish, retrying")
+        elif journal_size(journal_filename) == 0:
+            return False
+        else:
+            _journal.close()
+            os.replace(journal_filename, compacting)
+            _journal = open(journal_filename, 'a', encoding='utf-8')
+        users = [dict(user) for user in _users.values()]
+    tmp_filename = f"{filename}.tmp"
+    try:
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            json.dump(users, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+        os.remove(compacting)
+        logger.info(f"Compacted user journal into {filename} ({len(users)} users)")
+        return True
+    except Exception as e:
+        # The rotated journal stays on disk and is replayed or retried later
+        logger.error(f"Error compacting users into {filename}: {e}")
+        return False
+
+def close():
+    """Compact the journal and close it at shutdown"""
+    global _journal
+    compact()
+    with _lock:
+        if _journal is not None:
+            _journal.close()
+            _journal = None